@@ -7,6 +7,10 @@ import re
 import subprocess
 import json
 import copy
+import time
+import errno
+import threading
+import collections
 
 """
 Caching Update Server Tsomething And Resource Deployment
@@ -32,6 +36,30 @@ rcconf = "/etc/rc.conf"
 resolvconf = "/etc/resolv.conf"
 cache_dir = "/usr/local/www/nginx"
 cache_tool = "/usr/local/bin/ix-server-sync.py"
+# The cache tool's command line options for each of the Syncer's
+# arguments (see SyncerOptions()); a list repeats the option
+cache_tool_options = { "urls" : "--url",
+                       "projects" : "--project",
+                       "trains" : "--train",
+                       "verbose" : "--verbose",
+                       "fleet_logs" : "--fleet-log",
+                       "rate_limit" : "--rate-limit",
+                       "keep_releases" : "--keep-releases",
+                       "gc" : "--gc",
+                       "metrics_file" : "--metrics-file",
+                       }
+nginx_access_log = "/var/log/nginx/access.log"
+# Where node-exporter's textfile collector looks, if it runs here
+metrics_dir = "/var/tmp/node_exporter"
+# How often (in seconds) the progress view is redrawn
+progress_interval = 2
+# The cache tool, loaded as a module (see CacheModule()), and its Syncer,
+# kept between updates, along with the settings it was made with
+cache_module = None
+cache_syncer = None
+cache_syncer_options = None
+# The last update started from the menu; see UpdateCache()
+cache_update = None
 # This is a json file
 if debug:
     ConfigurationFile = "/tmp/custard.conf"
@@ -40,6 +68,8 @@ if debug:
     cache_dir = "/tmp/nginx"
 else:
     ConfigurationFile = "/usr/local/etc/custard.conf"
+# Where the cache tool reports how a sync is getting on
+progress_file = os.path.join(cache_dir, ".sync-progress")
 
 class Configuration(object):
     """
@@ -48,17 +78,30 @@ class Configuration(object):
     projects	-- a list of projects to use, in order
     deep	-- whether or not to do a deep copy
     verbose	-- whether or not to be verbose when syncing
+    rate_limits	-- bandwidth limits for syncing, as a list of
+    		   "HH:MM-HH:MM=rate" windows (rate in bytes/second,
+    		   with an optional k/M/G suffix; 0 means no limit)
+    keep_releases	-- how many previous manifests to keep for each
+    		   train, along with their packages
+    fleet_deltas	-- with a full copy, only copy the deltas from versions
+    		   that clients have asked for (from the nginx logs)
     """
     URL_KEY = "URL"
     PROJECT_KEY = "Projects"
     DEEP_KEY = "FullCopy"
     TRAIN_KEY = "Trains"
     VERBOSE_KEY = "Verbose"
+    RATE_KEY = "RateLimits"
+    KEEP_KEY = "KeepReleases"
+    FLEET_KEY = "FleetDeltas"
     default_urls = ["http://update.freenas.org", "http://update-master.freenas.org"]
     default_projects = ["FreeNAS", "TrueNAS" ]
     default_trains = []
     default_deep = True
     default_verbose = True
+    default_rate_limits = []
+    default_keep_releases = 0
+    default_fleet_deltas = False
     
     def __init__(self, loadFrom=None):
         if loadFrom:
@@ -69,6 +112,9 @@ class Configuration(object):
             self.trains = Configuration.default_trains
             self.deep = Configuration.default_deep
             self.verbose = Configuration.default_verbose
+            self.rate_limits = Configuration.default_rate_limits
+            self.keep_releases = Configuration.default_keep_releases
+            self.fleet_deltas = Configuration.default_fleet_deltas
         
     def Save(self, fobj):
         """
@@ -90,6 +136,12 @@ class Configuration(object):
             tdict[self.TRAIN_KEY] = self.trains
         tdict[self.DEEP_KEY] = self.deep
         tdict[self.VERBOSE_KEY] = self.verbose
+        if self.rate_limits:
+            tdict[self.RATE_KEY] = self.rate_limits
+        if self.keep_releases:
+            tdict[self.KEEP_KEY] = self.keep_releases
+        if self.fleet_deltas:
+            tdict[self.FLEET_KEY] = self.fleet_deltas
         
         json.dump(tdict, outfile, sort_keys=True,
                   indent=4, separators=(',', ': '))
@@ -122,6 +174,9 @@ class Configuration(object):
         self.trains = tdict.pop(Configuration.TRAIN_KEY, Configuration.default_trains)
         self.deep = tdict.pop(Configuration.DEEP_KEY, Configuration.default_deep)
         self.verbose = tdict.pop(Configuration.VERBOSE_KEY, Configuration.default_verbose)
+        self.rate_limits = tdict.pop(Configuration.RATE_KEY, Configuration.default_rate_limits)
+        self.keep_releases = tdict.pop(Configuration.KEEP_KEY, Configuration.default_keep_releases)
+        self.fleet_deltas = tdict.pop(Configuration.FLEET_KEY, Configuration.default_fleet_deltas)
         
         if isinstance(fobj, str) and infile:
             infile.close()
@@ -185,6 +240,39 @@ class Configuration(object):
     @verbose.setter
     def verbose(self, v):
         self._verbose = v
+
+    @property
+    def rate_limits(self):
+        return self._rate_limits
+    @rate_limits.setter
+    def rate_limits(self, limits):
+        if isinstance(limits, list):
+            self._rate_limits = limits[:]
+        elif isinstance(limits, tuple):
+            self._rate_limits = list(limits)
+        elif isinstance(limits, str):
+            self._rate_limits = [limits]
+        elif limits is None:
+            self._rate_limits = []
+        else:
+            raise ValueError("Inappropriate object type for rate limits")
+
+    @property
+    def keep_releases(self):
+        return self._keep_releases
+    @keep_releases.setter
+    def keep_releases(self, count):
+        count = int(count)
+        if count < 0:
+            raise ValueError("Number of releases to keep cannot be negative")
+        self._keep_releases = count
+
+    @property
+    def fleet_deltas(self):
+        return self._fleet_deltas
+    @fleet_deltas.setter
+    def fleet_deltas(self, f):
+        self._fleet_deltas = f
         
 def Ask(prompt, default, use_boolean=False, show_default=True):
     """
@@ -321,6 +409,32 @@ def ParseNetwork(text):
     if net and mask:
         return "%s/%s" % (net, mask)
     return None
+
+def ValidRateLimit(limit):
+    """
+    Returns a boolean indicating whether the input is a valid
+    bandwidth limit for the cache tool:  either "HH:MM-HH:MM=rate",
+    or just a rate, where the rate is a number of bytes/second,
+    optionally followed by k, M, or G.  If the cache tool can be
+    loaded, it decides; otherwise, we check it the same way.
+    """
+    if not limit:
+        return False
+    module = CacheModule()
+    if module and hasattr(module, "ParseSchedule"):
+        try:
+            module.ParseSchedule(limit)
+        except ValueError:
+            return False
+        return True
+    result = re.match(r"^((\d{1,2}):(\d\d)-(\d{1,2}):(\d\d)=)?\d+(\.\d+)?[kKmMgG]?$", limit)
+    if result is None:
+        return False
+    if result.group(1):
+        for (hours, minutes) in (result.group(2, 3), result.group(4, 5)):
+            if not (0 <= int(hours) <= 24 and 0 <= int(minutes) < 60):
+                return False
+    return True
         
 def GetInterfaceName():
     """
@@ -585,35 +699,353 @@ def ConfigInterface(config):
     print("Interface: %s" % GetInterfaceName())
     return new_config
 
-def RunCacheTool(arg):
-    config = Configuration(ConfigurationFile)
+def CacheToolCommand(arg):
+    """
+    Return the command line to run the cache tool with the
+    saved configuration, and arg (if any) at the end.
+    This is the command line version of SyncerOptions().
+    """
+    options = SyncerOptions(Configuration(ConfigurationFile))
     
     ctool = [cache_tool]
-    for url in config.url_list:
-        ctool.extend(["--url", url])
-    for project in config.projects:
-        ctool.extend(["--project", project])
-    for train in config.trains:
-        ctool.extend(["--train", train])
-    if config.deep:
-        ctool.append("--deep")
-    else:
-        ctool.append("--no-deep")
-    if config.verbose:
-        ctool.append("--verbose")
+    for (name, value) in sorted(options.items()):
+        if name == "deep":
+            ctool.append("--deep" if value else "--no-deep")
+        elif isinstance(value, bool):
+            if value:
+                ctool.append(cache_tool_options[name])
+        elif isinstance(value, list):
+            for item in value:
+                ctool.extend([cache_tool_options[name], item])
+        else:
+            ctool.extend([cache_tool_options[name], str(value)])
         
     if arg:
         ctool.append(arg)
         
     if debug:
         print(ctool, file=sys.stderr)
-        
-    import subprocess
+    return ctool
+
+def RunCacheTool(arg):
+    ctool = CacheToolCommand(arg)
     try:
-        subprocess.check_call(ctool)
-    except:
+        status = subprocess.call(ctool)
+    except OSError as e:
+        print("Could not run {0}: {1}".format(cache_tool, str(e)), file=sys.stderr)
+        return 1
+    if status != 0:
+        print("{0} failed (exit status {1})".format(cache_tool, status), file=sys.stderr)
+    return status
+
+def FormatBytes(n):
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if abs(n) < 1024:
+            break
+        n = n / 1024.0
+    else:
+        unit = "TB"
+    if unit == "bytes":
+        return "%d %s" % (n, unit)
+    return "%.1f %s" % (n, unit)
+
+def FormatTime(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+    return "%d:%02d" % (seconds // 60, seconds % 60)
+
+def LoadProgress():
+    """
+    Return what the cache tool last wrote to progress_file,
+    or None if there isn't anything (usable) there.
+    """
+    try:
+        with open(progress_file, "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def ProcessRunning(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def DrawProgress(progress, log_lines=[]):
+    """
+    Clear the screen, and show progress (as loaded by LoadProgress()).
+    log_lines are the last few messages from the cache tool.
+    """
+    now = time.time()
+    files = progress["Files"]
+    nbytes = progress["Bytes"]
+    print("\033[H\033[J", end="")
+    print("Cache update (pid %d), %s %s" %
+          (progress["PID"],
+           "running for" if progress["State"] == "running" else progress["State"] + " after",
+           FormatTime(progress["Updated"] - progress["Started"])))
+    print("Phase: %s" % progress["Phase"])
+    line = "Files: %d of %d done, %d to go" % (files["Done"], files["Total"], files["Remaining"])
+    if files["Failed"]:
+        line += ", %d failed" % files["Failed"]
+    print(line)
+    print("Data: %s of %s done, %s to go" % (FormatBytes(nbytes["Done"]),
+                                             FormatBytes(nbytes["Total"]),
+                                             FormatBytes(nbytes["Remaining"])))
+    line = "Throughput: %s/s" % FormatBytes(progress["Throughput"])
+    if progress["ETA"] is not None:
+        line += ", about %s left" % FormatTime(progress["ETA"])
+    print(line)
+    for mirror in progress["Mirrors"]:
+        print("    %s: %s/s, %d requests%s" % (mirror["URL"],
+                                              FormatBytes(mirror["Throughput"]),
+                                              mirror["Requests"],
+                                              "" if mirror["Up"] else " (not in use)"))
+    if progress["Transfers"]:
+        print("Downloading:")
+        for transfer in progress["Transfers"]:
+            done = transfer["Offset"] + transfer["Bytes"]
+            if transfer["Size"]:
+                amount = "%s of %s" % (FormatBytes(done), FormatBytes(transfer["Size"]))
+            else:
+                amount = FormatBytes(done)
+            print("    %s: %s from %s" % (transfer["Path"], amount, transfer["Mirror"]))
+    if now - progress["Updated"] > 10 * progress_interval:
+        print("(No news from the cache tool for %s)" % FormatTime(now - progress["Updated"]))
+    if log_lines:
+        print("")
+        for line in log_lines:
+            print(line)
+    if progress["State"] == "running":
+        print("\nPress control-C to stop watching")
+
+class LogTail(object):
+    """
+    The log for the cache tool's Syncer, when it runs in here;
+    keeps the last count lines it wrote.
+    """
+    def __init__(self, count=20):
+        self._lines = collections.deque(maxlen=count)
+        self._partial = ""
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            lines = (self._partial + text).split("\n")
+            self._partial = lines.pop()
+            self._lines.extend(lines)
+
+    def flush(self):
         pass
 
+    def Lines(self, count=None):
+        with self._lock:
+            lines = list(self._lines)
+        return lines[-count:] if count else lines
+
+def WatchProgress():
+    """
+    Show the progress of the cache update that is running (from
+    cron, say), every progress_interval seconds, until it is done,
+    or control-C is pressed.
+    """
+    try:
+        while True:
+            progress = LoadProgress()
+            if progress is None:
+                print("No cache update has been run")
+                return
+            if progress["State"] == "running" and not ProcessRunning(progress["PID"]):
+                print("The last cache update (pid %d) stopped without finishing" % progress["PID"])
+                return
+            DrawProgress(progress)
+            if progress["State"] != "running":
+                return
+            time.sleep(progress_interval)
+    except KeyboardInterrupt:
+        print("")
+
+def ShowProgress(unused=None):
+    if cache_update and cache_update["Thread"].is_alive():
+        WatchUpdate(cache_update)
+    else:
+        WatchProgress()
+
+def SyncerOptions(config):
+    """
+    The Syncer arguments for config.  CacheToolCommand() makes the
+    command line from these too, so anything added here needs an
+    entry in cache_tool_options.
+    """
+    options = { "urls" : config.url_list,
+                "projects" : config.projects,
+                "trains" : config.trains,
+                "deep" : config.deep,
+                "verbose" : config.verbose,
+                # Clean out anything the current manifests no longer need
+                "gc" : True,
+                }
+    if config.deep and config.fleet_deltas:
+        options["fleet_logs"] = [nginx_access_log]
+    if config.rate_limits:
+        options["rate_limit"] = ",".join(config.rate_limits)
+    if config.keep_releases:
+        options["keep_releases"] = config.keep_releases
+    if os.path.isdir(metrics_dir):
+        options["metrics_file"] = os.path.join(metrics_dir, "ix_server_sync.prom")
+    return options
+
+def CacheModule():
+    """
+    Return the cache tool, loaded as a module; it is loaded again
+    if it has changed since.  Returns None if it can't be loaded.
+    """
+    global cache_module, cache_syncer
+    import imp
+    try:
+        mtime = os.path.getmtime(cache_tool)
+        if cache_module is None or cache_module[0] != mtime:
+            cache_module = (mtime, imp.load_source("ix_server_sync", cache_tool))
+            cache_syncer = None
+    except (ImportError, IOError, OSError, SyntaxError) as e:
+        if debug:
+            print("Could not load {0}: {1}".format(cache_tool, str(e)), file=sys.stderr)
+        return None
+    return cache_module[1]
+
+def CacheSyncer():
+    """
+    Return the cache tool's Syncer for cache_dir, with the saved
+    configuration, so that we can sync without running it.  The same
+    one is used again while neither the configuration nor the tool
+    changes, which saves re-reading the index and reconnecting.
+    Returns None if the tool can't be loaded, or is too old to have a
+    Syncer; then it has to be run instead (see RunCacheTool()).
+    """
+    global cache_syncer, cache_syncer_options
+    module = CacheModule()
+    if module is None:
+        return None
+    try:
+        options = SyncerOptions(Configuration(ConfigurationFile))
+        if cache_syncer is None or cache_syncer_options != options:
+            if cache_syncer:
+                cache_syncer.Close()
+            cache_syncer = module.Syncer(cache_dir, **options)
+            cache_syncer_options = options
+    except (AttributeError, IOError, OSError, ValueError) as e:
+        if debug:
+            print("Could not load {0}: {1}".format(cache_tool, str(e)), file=sys.stderr)
+        return None
+    return cache_syncer
+
+def SyncCache(unused=None):
+    """
+    Update the cache, without showing anything but the
+    tool's own messages (as from cron).
+    """
+    syncer = CacheSyncer()
+    if syncer is None:
+        return RunCacheTool(cache_dir)
+    syncer.callback = None
+    syncer.log = None
+    try:
+        return 0 if syncer.Sync() else 1
+    finally:
+        syncer.Close()
+
+def WatchUpdate(update):
+    """
+    Show the progress of update (see UpdateCache()) until it is done.
+    Control-C asks whether to stop it, or leave it running in the
+    background.  Returns the exit status, or None if it is still running.
+    """
+    syncer = update["Syncer"]
+    log = update["Log"]
+    while update["Thread"].is_alive():
+        try:
+            if "Progress" in update:
+                DrawProgress(update["Progress"], log.Lines(update["Tail"]))
+            update["Thread"].join(progress_interval)
+        except KeyboardInterrupt:
+            try:
+                stop = Ask("\nStop the cache update", False, use_boolean=True)
+            except (EOFError, KeyboardInterrupt):
+                stop = False
+            if not stop:
+                print("The cache update continues in the background, until you exit")
+                return None
+            print("Stopping the cache update...")
+            syncer.Cancel()
+    if syncer.queued is not None:
+        # Most likely from cron; it takes our request along with it
+        print("A cache update (pid %d) is already running; it will run again when it is done" % syncer.queued)
+        WatchProgress()
+        return None
+    if "Progress" in update:
+        DrawProgress(update["Progress"], log.Lines(update["Tail"]))
+    if update["Result"]:
+        return 0
+    if syncer.cancelled:
+        print("\nThe cache update was stopped; the next one will carry on from there")
+    else:
+        print("\nThe cache update failed", file=sys.stderr)
+        for line in log.Lines():
+            print(line, file=sys.stderr)
+    return 1
+
+def UpdateCache(arg):
+    """
+    Update the cache in the background, showing its progress (see
+    WatchUpdate()).  If an update started here is still running,
+    this goes back to watching it.
+    """
+    global cache_update
+    if cache_update and cache_update["Thread"].is_alive():
+        return WatchUpdate(cache_update)
+    syncer = CacheSyncer()
+    if syncer is None:
+        return RunCacheTool(arg)
+    update = { "Syncer" : syncer,
+               "Result" : False,
+               }
+    def Watch(event, info):
+        if event == "progress":
+            update["Progress"] = info
+    def Run():
+        update["Result"] = syncer.Sync()
+    # Nothing else may write over the progress; the messages are
+    # shown below it, and there are a lot more of them when verbose.
+    update["Log"] = syncer.log = LogTail()
+    update["Tail"] = 15 if syncer.verbose else 5
+    syncer.callback = Watch
+    update["Thread"] = threading.Thread(target=Run)
+    update["Thread"].daemon = True
+    update["Thread"].start()
+    cache_update = update
+    return WatchUpdate(update)
+
+def ExitMenu(status):
+    """
+    Exit, but not in the middle of a cache update started from the
+    menu:  it runs in here, so exiting would cut it off part way.
+    """
+    if cache_update and cache_update["Thread"].is_alive():
+        print("A cache update is still running")
+        try:
+            stop = Ask("Stop it (otherwise, wait for it to finish)", False, use_boolean=True)
+        except (EOFError, KeyboardInterrupt):
+            return
+        if stop:
+            cache_update["Syncer"].Cancel()
+        WatchUpdate(cache_update)
+        if cache_update["Thread"].is_alive():
+            # Back to the menu, then
+            return
+    sys.exit(status)
+
 def Reboot(how):
     import subprocess
     if debug:
@@ -770,6 +1202,9 @@ def ConfigureCacheTool(unsued=None):
     2) Projects (FreeNAS and/or TrueNAS)
     3) Full copy (deep)
     4) Verbose
+    5) Bandwidth limits, by time of day
+    6) Number of previous releases to keep
+    7) Whether a full copy only gets the deltas clients use
     """
     config = Configuration(ConfigurationFile)
     try:
@@ -789,7 +1224,36 @@ def ConfigureCacheTool(unsued=None):
             config.url_list = url_list
 
         config.deep = Ask("Perform full copy", config.deep, use_boolean=True)
+        if config.deep:
+            config.fleet_deltas = Ask("Only copy deltas for versions clients are running",
+                                      config.fleet_deltas, use_boolean=True)
         config.verbose = Ask("Verbose copy", config.verbose, use_boolean=True)
+
+        current_limits = None
+        if config.rate_limits:
+            current_limits = ", ".join(config.rate_limits)
+        new_limits = Ask("""Bandwidth limits, as a list of time windows and rates, e.g.
+            08:00-18:00=512k, 18:00-08:00=0
+            (rates are bytes/second; 0 means no limit; "none" for no limits)
+            Bandwidth limits""", current_limits)
+        if new_limits is None or new_limits.lower() == "none":
+            config.rate_limits = []
+        else:
+            rate_limits = []
+            for limit in new_limits.split(","):
+                limit = limit.strip()
+                if not ValidRateLimit(limit):
+                    print("{0} is not a valid bandwidth limit".format(limit), file=sys.stderr)
+                    return
+                rate_limits.append(limit)
+            config.rate_limits = rate_limits
+
+        new_keep = Ask("Previous releases to keep for each train", str(config.keep_releases))
+        try:
+            config.keep_releases = new_keep
+        except ValueError:
+            print("{0} is not a valid number of releases".format(new_keep), file=sys.stderr)
+            return
     except EOFError:
         print("\nNo changes made")
         return
@@ -835,20 +1299,20 @@ def main():
     """
     if len(sys.argv) > 1:
         if sys.argv[1] == "--update-cache":
-            RunCacheTool(cache_dir)
-            sys.exit(0)
+            sys.exit(1 if SyncCache() else 0)
     
     menu_items = [
         ("Configure Networking", DoConfigInterface, system_config),
         ("Set hostname", SetHostname, system_config),
-        ("Update cache", RunCacheTool, cache_dir),
+        ("Update cache", UpdateCache, cache_dir),
+        ("Show cache update progress", ShowProgress, None),
         ("Check for cache-tool update", RunCacheTool, "--check-for-update"),
         ("Configure cache tool settings", ConfigureCacheTool, None),
         ("Shell", RunShell, None),
         ("Configure cron updates", ConfigureCron, None),
         ("Reboot", Reboot, "reboot"),
         ("Shutdown", Reboot, "shutdown"),
-        ("Exit", sys.exit, 0),
+        ("Exit", ExitMenu, 0),
         ]
     
     while True:
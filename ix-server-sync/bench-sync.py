@@ -0,0 +1,517 @@
+#!/usr/local/bin/python
+"""
+Benchmark ix-server-sync.py against a local stand-in for
+update.freenas.org.
+
+A synthetic update tree (trains.txt, LATEST manifests with packages,
+upgrade deltas, notes and a validator, and the package files) is
+generated from a seed, so the same options always give the same tree,
+and served over HTTP from this process, optionally with added latency,
+a bandwidth cap, spurious 416s, and connections reset part way through
+a file.  Then ix-server-sync.py is run against it, into a real cache
+directory, for each scenario:
+
+	cold		an empty cache
+	noop		nothing has changed upstream
+	incremental	some packages have new versions
+	resume		the first attempt at a new release fails part way
+			through (every package transfer is reset); the time
+			is for the run after that, which picks up the pieces
+
+Each scenario's time, exit status, and the requests and bytes the
+server saw are printed, and saved as JSON with --json, so changes to
+the sync can be compared against them.
+"""
+from __future__ import print_function
+import os, sys
+import email.utils
+import getopt
+import hashlib
+import json
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+if sys.version_info[0] < 3:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+verbose = False
+
+# What runs the sync; it needs whatever Python it is written for
+python = sys.executable
+
+# The faults the server injects; see StandInHandler
+latency = 0.0
+bandwidth = None
+rate_416 = 0.0
+reset_rate = 0.0
+
+# What the server has done since the last ResetServerStats()
+server_stats = { "Requests" : 0, "Bytes" : 0, "Resets" : 0, "Injected416" : 0 }
+server_stats_lock = threading.Lock()
+
+SCENARIOS = ["cold", "noop", "incremental", "resume"]
+
+def ParseSize(value):
+    """
+    Parse a size such as 512, 64k, 10M or 1G (powers of 1024).
+    """
+    value = value.strip()
+    multiplier = 1
+    if value and value[-1].upper() in "KMG":
+        multiplier = 1024 ** ("KMG".index(value[-1].upper()) + 1)
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+class TreeGenerator(object):
+    """
+    Makes the synthetic update tree under root:  for each project,
+    trains.txt, and for each train a LATEST manifest, release notes,
+    and a ChangeLog.txt; the project's Validators and Packages.
+    Package contents are a header naming the file, padded out to size
+    with bytes from a block generated from the seed, so every file has
+    its own checksum, and the tree is the same every time.
+    """
+    def __init__(self, root, projects, trains=2, packages=100, package_size=1024 * 1024,
+                 delta_size=None, seed=0):
+        self.root = root
+        self.projects = projects
+        self.trains = trains
+        self.packages = packages
+        self.package_size = package_size
+        self.delta_size = delta_size if delta_size is not None else max(1, package_size // 10)
+        self.random = random.Random(seed)
+        self.block = b"".join(struct.pack("<Q", self.random.getrandbits(64)) for i in range(8192))
+        self.release = 0
+
+    def _Data(self, name, size):
+        header = ("%s\n" % name).encode("utf-8")
+        size = max(size, len(header))
+        data = [header]
+        remaining = size - len(header)
+        while remaining > 0:
+            data.append(self.block[:remaining])
+            remaining -= len(data[-1])
+        return b"".join(data)
+
+    def _Write(self, path, data):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        with open(path, "wb") as f:
+            f.write(data)
+        return (hashlib.sha256(data).hexdigest(), len(data))
+
+    def _Package(self, project, name, version, old_versions):
+        pkg_dir = os.path.join(self.root, project, "Packages")
+        (checksum, size) = self._Write(os.path.join(pkg_dir, "%s-%s.tgz" % (name, version)),
+                                       self._Data("%s/%s-%s" % (project, name, version), self.package_size))
+        package = { "Name" : name, "Version" : version, "Checksum" : checksum, "FileSize" : size }
+        upgrades = []
+        for old in old_versions:
+            (checksum, size) = self._Write(os.path.join(pkg_dir, "%s-%s-%s.tgz" % (name, old, version)),
+                                           self._Data("%s/%s-%s-%s" % (project, name, old, version),
+                                                      self.delta_size))
+            upgrades.append({ "Version" : old, "Checksum" : checksum, "FileSize" : size })
+        if upgrades:
+            package["Upgrades"] = upgrades
+        return package
+
+    def _Manifests(self, project):
+        retval = []
+        for t in range(self.trains):
+            train = "%s-TRAIN-%d" % (project, t)
+            retval.append((train, os.path.join(self.root, project, train, "LATEST")))
+        return retval
+
+    def Generate(self):
+        """
+        Make the first release.
+        """
+        self.release = 1
+        for project in self.projects:
+            project_dir = os.path.join(self.root, project)
+            self._Write(os.path.join(project_dir, "Validators", "ValidateUpdate"),
+                        "#!/bin/sh\nexit 0\n")
+            packages = [self._Package(project, "pkg%04d" % i, "1.0", [])
+                        for i in range(self.packages)]
+            trains = []
+            for (train, latest) in self._Manifests(project):
+                trains.append("%s\t%s release train" % (train, project))
+                self._Release(project, train, latest, packages)
+            self._Write(os.path.join(project_dir, "trains.txt"), "\n".join(trains) + "\n")
+
+    def Update(self, fraction):
+        """
+        Make a new release, in which fraction of the packages have
+        a new version (with deltas from the last two).
+        """
+        self.release += 1
+        for project in self.projects:
+            manifests = self._Manifests(project)
+            with open(manifests[0][1], "r") as f:
+                packages = json.load(f)["Packages"]
+            changed = self.random.sample(range(len(packages)), int(round(len(packages) * fraction)))
+            for index in changed:
+                package = packages[index]
+                old = [package["Version"]] + [u["Version"] for u in package.get("Upgrades", [])][:1]
+                version = "%d.0" % (int(float(package["Version"])) + 1)
+                packages[index] = self._Package(project, package["Name"], version, old)
+            for (train, latest) in manifests:
+                self._Release(project, train, latest, packages)
+
+    def _Release(self, project, train, latest, packages):
+        train_dir = os.path.dirname(latest)
+        notes = "ReleaseNotes-%d" % self.release
+        self._Write(os.path.join(train_dir, "Notes", notes), "Release %d of %s\n" % (self.release, train))
+        self._Write(os.path.join(train_dir, "ChangeLog.txt"), "".join("%d: release %d\n" % (r, r)
+                                                                      for r in range(1, self.release + 1)))
+        with open(os.path.join(self.root, project, "Validators", "ValidateUpdate"), "rb") as f:
+            validator = hashlib.sha256(f.read()).hexdigest()
+        manifest = { "Train" : train,
+                     "Sequence" : "%s-%d" % (train, self.release),
+                     "Packages" : packages,
+                     "Notes" : { "ReleaseNotes" : notes },
+                     "UpdateCheckProgram" : { "Name" : "ValidateUpdate", "Checksum" : validator },
+                 }
+        self._Write(latest, json.dumps(manifest, sort_keys=True, indent=4))
+
+    def Size(self):
+        total = 0
+        for (dirpath, dirnames, filenames) in os.walk(self.root):
+            total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+        return total
+
+def ResetServerStats():
+    with server_stats_lock:
+        retval = dict(server_stats)
+        for key in server_stats:
+            server_stats[key] = 0
+    return retval
+
+def CountServer(key, n=1):
+    with server_stats_lock:
+        server_stats[key] += n
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves the tree in server.root like nginx does for the real
+    server:  keep-alive, ETag and Last-Modified, If-None-Match,
+    Range and If-Range.  Adds the faults in the globals:  latency
+    before each response, a cap (bytes per second) on each response,
+    and, at the given rates, a 416 for a Range request, or a reset
+    half way through the body of a package.
+    """
+    protocol_version = "HTTP/1.1"
+    # Otherwise each keep-alive response waits on a delayed ACK
+    disable_nagle_algorithm = True
+    CHUNK = 16 * 1024
+
+    def log_message(self, format, *args):
+        if verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _Status(self, code, headers=()):
+        self.send_response(code)
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _Reset(self):
+        # SO_LINGER with a zero timeout sends a RST, not a FIN
+        CountServer("Resets")
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        self.close_connection = True
+
+    def _Serve(self, body):
+        CountServer("Requests")
+        if latency:
+            time.sleep(latency)
+        path = os.path.normpath(self.path.split("?")[0]).lstrip("/")
+        local = os.path.join(self.server.root, path)
+        if path.startswith("..") or not os.path.isfile(local):
+            self._Status(404)
+            return
+        st = os.stat(local)
+        etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+        modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        validators = [("ETag", etag), ("Last-Modified", modified)]
+        if self.headers.get("If-None-Match") == etag:
+            self._Status(304, validators)
+            return
+        (start, end, code) = (0, st.st_size - 1, 200)
+        byte_range = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if byte_range and byte_range.startswith("bytes=") and if_range in (None, etag, modified):
+            (first, last) = byte_range[len("bytes="):].split(",")[0].split("-")
+            start = int(first) if first else max(0, st.st_size - int(last))
+            if first and last:
+                end = min(int(last), st.st_size - 1)
+            if start >= st.st_size or random.random() < rate_416:
+                if start < st.st_size:
+                    CountServer("Injected416")
+                self._Status(416, [("Content-Range", "bytes */%d" % st.st_size)])
+                return
+            code = 206
+        self.send_response(code)
+        for (name, value) in validators:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(end - start + 1))
+        if code == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, st.st_size))
+        self.end_headers()
+        if not body:
+            return
+        reset_at = None
+        if "/Packages/" in self.path and random.random() < reset_rate:
+            reset_at = start + (end - start + 1) // 2
+        with open(local, "rb") as f:
+            f.seek(start)
+            position = start
+            started = time.time()
+            while position <= end:
+                data = f.read(min(self.CHUNK, end - position + 1))
+                if not data:
+                    break
+                if reset_at is not None and position + len(data) > reset_at:
+                    self.wfile.write(data[:reset_at - position])
+                    self.wfile.flush()
+                    self._Reset()
+                    return
+                self.wfile.write(data)
+                position += len(data)
+                CountServer("Bytes", len(data))
+                if bandwidth:
+                    ahead = (position - start) / float(bandwidth) - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def do_GET(self):
+        self._Serve(True)
+
+    def do_HEAD(self):
+        self._Serve(False)
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Syncs open a burst of connections at once
+    request_queue_size = 128
+
+def StartServer(root):
+    """
+    Start serving root on a free port on localhost, and return
+    a tuple of (server, URL); the caller shuts the server down.
+    """
+    server = StandInServer(("127.0.0.1", 0), StandInHandler)
+    server.root = root
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return (server, "http://127.0.0.1:%d" % server.server_address[1])
+
+def RunSync(sync, url, cache_dir, args):
+    """
+    Run the sync, and return (seconds, exit status, server stats).
+    """
+    command = [python, sync, "--url", url] + args + [cache_dir]
+    if verbose:
+        print(" ".join(command), file=sys.stderr)
+    ResetServerStats()
+    started = time.time()
+    with open(os.devnull, "w") as devnull:
+        status = subprocess.call(command, stdout=None if verbose else devnull,
+                                 stderr=None if verbose else devnull)
+    elapsed = time.time() - started
+    return (elapsed, status, ResetServerStats())
+
+def RunScenarios(sync, generator, url, cache_dir, args, changed):
+    """
+    Run each of SCENARIOS in order, against a fresh cache_dir.
+    Returns a dictionary of scenario name to result.
+    """
+    global reset_rate
+    results = {}
+    def Record(name, result):
+        (elapsed, status, stats) = result
+        results[name] = { "Seconds" : elapsed, "Status" : status }
+        results[name].update(stats)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+    Record("cold", RunSync(sync, url, cache_dir, args))
+    Record("noop", RunSync(sync, url, cache_dir, args))
+    generator.Update(changed)
+    Record("incremental", RunSync(sync, url, cache_dir, args))
+
+    generator.Update(changed)
+    saved = reset_rate
+    reset_rate = 1.0
+    try:
+        (elapsed, status, stats) = RunSync(sync, url, cache_dir, args + ["--retries", "1"])
+    finally:
+        reset_rate = saved
+    if status == 0:
+        print("Warning: the interrupted run for the resume scenario succeeded", file=sys.stderr)
+    Record("resume", RunSync(sync, url, cache_dir, args))
+    results["resume"]["FailedRunSeconds"] = elapsed
+    return results
+
+def Median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def main():
+    global verbose, python, latency, bandwidth, rate_416, reset_rate
+
+    def Usage():
+        print("""Usage:\t{0} [-v] [-n packages] [--size size] [--delta-size size] [-P project] [--trains count]
+\t\t[--seed n] [--changed fraction] [--latency ms] [--bandwidth rate] [--416-rate fraction]
+\t\t[--reset-rate fraction] [--repeat count] [--cache-dir dir] [--sync path] [--python path] [--json file]
+\t\t[-- sync options...]""".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        opts, arguments = getopt.getopt(sys.argv[1:], "vn:P:",
+                                        ["verbose", "packages=", "size=", "delta-size=", "project=",
+                                         "trains=", "seed=", "changed=", "latency=", "bandwidth=",
+                                         "416-rate=", "reset-rate=", "repeat=", "cache-dir=",
+                                         "sync=", "python=", "json="])
+    except getopt.GetoptError as err:
+        print(str(err), file=sys.stderr)
+        Usage()
+
+    packages = 100
+    package_size = 1024 * 1024
+    delta_size = None
+    projects = []
+    trains = 2
+    seed = 0
+    changed = 0.1
+    repeat = 1
+    cache_dir = None
+    sync = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ix-server-sync.py")
+    json_file = None
+
+    try:
+        for o, a in opts:
+            if o in ("-v", "--verbose"):
+                verbose = True
+            elif o in ("-n", "--packages"):
+                packages = int(a)
+            elif o == "--size":
+                package_size = ParseSize(a)
+            elif o == "--delta-size":
+                delta_size = ParseSize(a)
+            elif o in ("-P", "--project"):
+                projects.append(a)
+            elif o == "--trains":
+                trains = int(a)
+            elif o == "--seed":
+                seed = int(a)
+            elif o == "--changed":
+                changed = float(a)
+            elif o == "--latency":
+                latency = float(a) / 1000
+            elif o == "--bandwidth":
+                bandwidth = ParseSize(a)
+            elif o == "--416-rate":
+                rate_416 = float(a)
+            elif o == "--reset-rate":
+                reset_rate = float(a)
+            elif o == "--repeat":
+                repeat = max(1, int(a))
+            elif o == "--cache-dir":
+                cache_dir = a
+            elif o == "--sync":
+                sync = a
+            elif o == "--python":
+                python = a
+            elif o == "--json":
+                json_file = a
+    except ValueError:
+        Usage()
+    if not projects:
+        projects = ["FreeNAS"]
+    # For the faults
+    random.seed(seed)
+    sync_args = ["--deep"] + arguments
+    for project in projects:
+        sync_args.extend(["--project", project])
+
+    work = tempfile.mkdtemp(prefix="bench-sync.")
+    try:
+        runs = []
+        for run in range(repeat):
+            tree = os.path.join(work, "tree")
+            if os.path.exists(tree):
+                shutil.rmtree(tree)
+            generator = TreeGenerator(tree, projects, trains=trains, packages=packages,
+                                      package_size=package_size, delta_size=delta_size, seed=seed)
+            generator.Generate()
+            if run == 0:
+                print("Tree:  %d projects, %d trains, %d packages of %d bytes, %d bytes in all" %
+                      (len(projects), trains, packages, package_size, generator.Size()))
+            (server, url) = StartServer(tree)
+            try:
+                runs.append(RunScenarios(sync, generator, url, cache_dir or os.path.join(work, "cache"),
+                                         sync_args, changed))
+            finally:
+                server.shutdown()
+                server.server_close()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    results = {}
+    print("%-12s %10s %7s %10s %14s" % ("Scenario", "Seconds", "Status", "Requests", "Bytes"))
+    for name in SCENARIOS:
+        # The medians, and the worst exit status
+        results[name] = { "Seconds" : Median([r[name]["Seconds"] for r in runs]),
+                          "Status" : max(r[name]["Status"] for r in runs),
+                          "Requests" : Median([r[name]["Requests"] for r in runs]),
+                          "Bytes" : Median([r[name]["Bytes"] for r in runs]),
+                          "Runs" : [r[name] for r in runs],
+                      }
+        print("%-12s %10.3f %7d %10d %14d" % (name, results[name]["Seconds"], results[name]["Status"],
+                                              results[name]["Requests"], results[name]["Bytes"]))
+
+    if json_file:
+        report = { "Time" : int(time.time()),
+                   "Parameters" : { "Projects" : projects,
+                                    "Trains" : trains,
+                                    "Packages" : packages,
+                                    "PackageSize" : package_size,
+                                    "DeltaSize" : delta_size,
+                                    "Seed" : seed,
+                                    "Changed" : changed,
+                                    "Latency" : latency,
+                                    "Bandwidth" : bandwidth,
+                                    "Rate416" : rate_416,
+                                    "ResetRate" : reset_rate,
+                                    "Repeat" : repeat,
+                                    "SyncArguments" : sync_args,
+                                },
+                   "Results" : results,
+               }
+        with open(json_file, "w") as f:
+            json.dump(report, f, sort_keys=True, indent=4, separators=(',', ': '))
+    return 1 if any(r[name]["Status"] for r in runs for name in SCENARIOS) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
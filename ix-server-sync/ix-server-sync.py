@@ -2,14 +2,106 @@
 from __future__ import print_function
 import os, sys
 import json
+import hashlib
+import errno
+import fcntl
+import heapq
+import math
+import random
+import re
+import select
+import socket
+import tempfile
+import threading
+import time
+
+if sys.version_info[0] < 3:
+    import Queue as queue
+    import httplib
+    from urllib import getproxies, proxy_bypass
+    from urllib2 import HTTPError
+    from urlparse import urlsplit, urljoin
+else:
+    import queue
+    import http.client as httplib
+    from urllib.request import getproxies, proxy_bypass
+    from urllib.error import HTTPError
+    from urllib.parse import urlsplit, urljoin
 
 debug = False
 verbose = False
+# Where messages go:  sys.stderr, unless a Syncer was given a log
+sync_log = sys.stderr
 
 Projects = [ "FreeNAS", "TrueNAS" ]
 
 Version = "1.0"
 url_list = []
+# Used when no --url is given
+default_urls = ["http://update.freenas.org", "http://update-master.freenas.org"]
+
+# Number of files downloaded at once, in total and from any one mirror.
+max_jobs = 4
+max_mirror_jobs = None
+mirror_slots = {}
+mirror_slots_lock = threading.Lock()
+
+# Keep-alive connections, one ConnectionPool per mirror
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+# The FileIndex for the destination, if there is one
+file_index = None
+
+# The MirrorManager for url_list; see GetMirrors()
+mirror_manager = None
+mirror_manager_lock = threading.Lock()
+
+# Files at least segment_threshold bytes long are fetched as
+# max_segments byte ranges at once, spread across the mirrors.
+max_segments = 4
+segment_threshold = 64 * 1024 * 1024
+
+# The RateLimiter for downloads, if --rate-limit was given
+rate_limiter = None
+
+# The BlobStore shared by all the projects in the destination
+blob_store = None
+
+# How many old manifests (in <train>/History) are kept for each train,
+# along with the files they refer to.
+keep_releases = 0
+
+# The FleetVersions, if only the deltas our clients use are wanted
+fleet_versions = None
+
+# A failed download is tried again up to max_attempts times in all,
+# waiting about retry_delay seconds, doubling each time (up to
+# max_retry_delay), before each retry.
+max_attempts = 5
+retry_delay = 2.0
+max_retry_delay = 60.0
+
+# How downloads are done:  "threads" (DownloadPool, a thread for each)
+# or "events" (EventDownloadPool, all from one thread)
+download_engine = "threads"
+
+# Bytes transferred this run, and the time spent transferring them
+transfer_totals = { "Bytes" : 0, "Seconds" : 0.0 }
+transfer_totals_lock = threading.Lock()
+
+# What this run has done; see SyncMetrics
+sync_metrics = None
+
+# How this run is getting on, for anyone watching; see SyncProgress
+sync_progress = None
+
+# Set to stop the run in progress as soon as it can; see Syncer.Cancel()
+sync_cancelled = threading.Event()
+
+# The settings and state of a run are the globals above, so only one
+# Syncer runs at a time.
+syncer_lock = threading.Lock()
 
 def CheckForUpdate():
     """
@@ -49,14 +141,951 @@ def CheckForUpdate():
     return
 
 
-def GetNetworkFile(path, out=None, resume=False):
+def MirrorSlot(base_url):
+    """
+    Return the semaphore that limits the number of concurrent
+    transfers from base_url.  The limit is max_mirror_jobs, or
+    max_jobs if that is not set.
+    """
+    with mirror_slots_lock:
+        if base_url not in mirror_slots:
+            mirror_slots[base_url] = threading.BoundedSemaphore(max_mirror_jobs or max_jobs)
+        return mirror_slots[base_url]
+
+class PooledResponse(object):
+    """
+    Wraps an httplib response, so that closing it hands the
+    connection back to its ConnectionPool.  The connection is only
+    re-used if the whole body was read, and the server did not
+    ask to close it.
+    """
+    def __init__(self, pool, conn, response, url):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.code = response.status
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._response.read()
+        return self._response.read(amt)
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn = self._conn
+        self._conn = None
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.Release(conn)
+        else:
+            self._response.close()
+            conn.close()
+
+class ConnectionPool(object):
+    """
+    A pool of keep-alive HTTP connections to a single server.
+    Idle connections are kept after a request has finished, and
+    handed out again for the next one, so a sync run only pays for
+    DNS and the TCP (and TLS) handshake once per concurrent transfer,
+    instead of once per file.  Proxies are honoured the same way
+    urllib does.
+    """
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme or "http"
+        self.host = parts.netloc
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._proxy = None
+        proxy = getproxies().get(self.scheme)
+        if proxy and not proxy_bypass(parts.hostname or self.host):
+            self._proxy = urlsplit(proxy).netloc or proxy
+
+    def _Connect(self):
+        if self.scheme == "https":
+            if self._proxy:
+                conn = httplib.HTTPSConnection(self._proxy, timeout=self.timeout)
+                conn.set_tunnel(self.host)
+            else:
+                conn = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self._proxy or self.host, timeout=self.timeout)
+        return conn
+
+    def Release(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    def Close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            conn.close()
+
+    def Request(self, path, headers=None, method="GET"):
+        """
+        Issue a request for path (which must start with "/"), and
+        return a PooledResponse for it.  The caller must close()
+        the response.  If an idle connection turns out to have been
+        closed by the server, the request is retried once on a new one.
+        """
+        if self._proxy and self.scheme == "http":
+            target = "http://%s%s" % (self.host, path)
+        else:
+            target = path
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = self._Connect()
+            try:
+                conn.request(method, target, headers=headers or {})
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            return PooledResponse(self, conn, response,
+                                  "%s://%s%s" % (self.scheme, self.host, path))
+
+def GetConnectionPool(base_url):
+    """
+    Return the ConnectionPool for the server base_url lives on.
+    All fetches in a run share these.
+    """
+    parts = urlsplit(base_url)
+    key = "%s://%s" % (parts.scheme or "http", parts.netloc)
+    with connection_pools_lock:
+        if key not in connection_pools:
+            connection_pools[key] = ConnectionPool(key)
+        return connection_pools[key]
+
+def CloseConnectionPools():
+    with connection_pools_lock:
+        pools = list(connection_pools.values())
+        connection_pools.clear()
+    for pool in pools:
+        pool.Close()
+
+def OpenURL(url, headers=None, method="GET"):
+    """
+    Open url using the pooled connections, following redirects.
+    Returns a PooledResponse for a successful request, and raises
+    HTTPError (as urlopen would) for an error status.
+    """
+    for redirect in range(5):
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = path + "?" + parts.query
+        response = GetConnectionPool(url).Request(path, headers=headers, method=method)
+        if response.code in (301, 302, 303, 307, 308) and response.getheader("Location"):
+            response.read()
+            response.close()
+            url = urljoin(url, response.getheader("Location"))
+            continue
+        if response.code >= 400:
+            response.read()
+            response.close()
+            raise HTTPError(url, response.code, httplib.responses.get(response.code, ""),
+                            {"Content-Range" : response.getheader("Content-Range")}, None)
+        return response
+    raise HTTPError(url, response.code, "Too many redirects", None, None)
+
+class FileIndex(object):
+    """
+    A persistent index of the files we have downloaded, kept as an
+    append-only log of JSON lines (the last line for a path wins).
+    For each file it records the size, the upstream validators
+    (ETag, Last-Modified, Content-Length), the SHA-256 of the contents,
+    and whether the download completed.  A file the index says is
+    complete, and that still has the recorded size, does not need to
+    be asked about again.  Paths are stored relative to the directory
+    the index lives in.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self._entries = {}
+        self._lines = 0
+        # Whether anything has been written since the last Close()
+        self._written = False
+        self._lock = threading.Lock()
+        self._log = None
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    self._lines += 1
+                    try:
+                        entry = json.loads(line)
+                        key = entry["Path"]
+                    except:
+                        # Most likely a partial line from a crash
+                        continue
+                    if entry.get("Removed"):
+                        self._entries.pop(key, None)
+                    else:
+                        self._entries[key] = entry
+        except IOError:
+            pass
+        self._stat = self._Stat()
+
+    def _Stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_size, st.st_mtime)
+        except OSError:
+            return None
+
+    def _Key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def _Append(self, entry):
+        # Must be called with the lock held
+        if self._log is None:
+            self._log = open(self.path, "a")
+        self._log.write(json.dumps(entry, sort_keys=True) + "\n")
+        self._log.flush()
+        self._lines += 1
+        self._written = True
+
+    def Lookup(self, path):
+        """
+        Return the entry for path (a dictionary), or None.
+        """
+        with self._lock:
+            entry = self._entries.get(self._Key(path))
+        return dict(entry) if entry else None
+
+    def IsComplete(self, path):
+        """
+        Return True if path was completely downloaded, and is
+        still the size it was then.  This does no network I/O.
+        """
+        entry = self.Lookup(path)
+        if not entry or not entry.get("Complete"):
+            return False
+        try:
+            return os.path.getsize(path) == entry["Size"]
+        except OSError:
+            return False
+
+    def Record(self, path, **kwargs):
+        """
+        Record information about path.  The keyword arguments
+        are the fields to set (e.g., Size, ETag, SHA256, Complete).
+        """
+        key = self._Key(path)
+        entry = { "Path" : key }
+        entry.update(kwargs)
+        with self._lock:
+            self._entries[key] = entry
+            self._Append(entry)
+
+    def Forget(self, path):
+        key = self._Key(path)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._Append({ "Path" : key, "Removed" : True })
+
+    def Close(self):
+        """
+        Close the log, compacting it first if most of it has
+        been superseded.  An index that has only been read (as for
+        a plan) is left alone.
+        """
+        with self._lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+            if self._written and self._lines > 2 * len(self._entries) + 100:
+                tmp = self.path + ".tmp"
+                with open(tmp, "w") as f:
+                    for key in sorted(self._entries.keys()):
+                        f.write(json.dumps(self._entries[key], sort_keys=True) + "\n")
+                os.rename(tmp, self.path)
+                self._lines = len(self._entries)
+            self._written = False
+            self._stat = self._Stat()
+
+    def Changed(self):
+        """
+        Return True if something else (such as a sync in another
+        process) has written the index since it was loaded or last
+        closed, so that what we have in memory is out of date.
+        """
+        with self._lock:
+            return self._log is None and self._Stat() != self._stat
+
+def ResponseValidators(response):
+    """
+    Return the validators from an HTTP response, as a dictionary
+    suitable for FileIndex.Record().
+    """
+    retval = {}
+    for (header, key) in (("ETag", "ETag"),
+                          ("Last-Modified", "LastModified")):
+        value = response.getheader(header)
+        if value:
+            retval[key] = value
+    return retval
+
+def CountTransfer(nbytes, seconds):
+    with transfer_totals_lock:
+        transfer_totals["Bytes"] += nbytes
+        transfer_totals["Seconds"] += seconds
+
+def SetPhase(phase):
+    if sync_progress:
+        sync_progress.SetPhase(phase)
+
+def CountMetric(name, n=1):
+    if sync_metrics:
+        sync_metrics.Count(name, n)
+
+class SyncCancelled(Exception):
+    """
+    Raised by anything talking to the mirrors once the run
+    has been cancelled (see Syncer.Cancel()).
+    """
+    pass
+
+def CheckCancelled():
+    if sync_cancelled.is_set():
+        raise SyncCancelled("Sync cancelled")
+
+def LoadSyncStats(destination):
+    """
+    Return the statistics saved by the last sync into destination
+    (a dictionary, which may be empty).
+    """
+    try:
+        with open(os.path.join(destination, ".sync-stats"), "r") as f:
+            return json.load(f)
+    except:
+        return {}
+
+def LoadSyncSummary(destination):
+    """
+    Return the summary (see SyncMetrics) the last sync into
+    destination left, or an empty dictionary.
+    """
+    try:
+        with open(os.path.join(destination, ".sync-summary"), "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def SaveSyncStats(destination, stats):
+    tmp = os.path.join(destination, ".sync-stats.tmp")
+    with open(tmp, "w") as f:
+        json.dump(stats, f, sort_keys=True, indent=4, separators=(',', ': '))
+    os.rename(tmp, os.path.join(destination, ".sync-stats"))
+
+class SyncMetrics(object):
+    """
+    What a sync run did, for monitoring:  files and bytes by what
+    happened to them (Count()), how long each phase of the run took
+    (RecordPhase()), and how long each file took to download (RecordFile()).
+    Transfer totals, mirrors and retries are added at the end by
+    Summary(), which returns the lot as a dictionary; WriteSummary()
+    saves that as JSON, and WriteTextfile() in the Prometheus text
+    format, for node-exporter's textfile collector.
+    """
+    # Buckets, in seconds, for the per-file download time histogram
+    FILE_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900)
+    # How many of the slowest files the summary lists
+    SLOWEST = 10
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counts = {}
+        for kind in ("Fetched", "Resumed", "Skipped", "Linked", "Deleted"):
+            self.counts["Files" + kind] = 0
+            self.counts["Bytes" + kind] = 0
+        self.counts["FilesNotModified"] = 0
+        self.phases = {}
+        self.file_buckets = [0] * len(self.FILE_BUCKETS)
+        self.file_count = 0
+        self.file_seconds = 0.0
+        self.slowest = []
+
+    def Count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def RecordFile(self, path, seconds):
+        with self._lock:
+            self.file_count += 1
+            self.file_seconds += seconds
+            for (index, bound) in enumerate(self.FILE_BUCKETS):
+                if seconds <= bound:
+                    self.file_buckets[index] += 1
+            self.slowest.append((seconds, path))
+            self.slowest.sort(reverse=True)
+            del self.slowest[self.SLOWEST:]
+
+    def RecordPhase(self, name, started):
+        """
+        Add the time since started to phase name.
+        """
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + time.time() - started
+
+    def Summary(self, pool=None, success=True):
+        """
+        Return everything as a dictionary.  pool is the run's
+        DownloadPool, for the retries and failures.
+        """
+        elapsed = time.time() - self.started
+        with self._lock:
+            counts = dict(self.counts)
+            phases = dict(self.phases)
+            files = { "Count" : self.file_count,
+                      "Seconds" : self.file_seconds,
+                      "Buckets" : list(zip(self.FILE_BUCKETS, self.file_buckets)),
+                      "Slowest" : [{ "Path" : path, "Seconds" : seconds }
+                                   for (seconds, path) in self.slowest],
+                  }
+        with transfer_totals_lock:
+            counts["BytesFetched"] = transfer_totals["Bytes"]
+            transfer_seconds = transfer_totals["Seconds"]
+        phases["Total"] = elapsed
+        return { "Time" : int(time.time()),
+                 "Success" : success,
+                 "Counts" : counts,
+                 "Phases" : phases,
+                 "Files" : files,
+                 "Throughput" : counts["BytesFetched"] / elapsed if elapsed > 0 else 0.0,
+                 "TransferSeconds" : transfer_seconds,
+                 "Retries" : pool.retries if pool else 0,
+                 "Failures" : len(pool.failures) if pool else 0,
+                 "Mirrors" : GetMirrors().Summary() if url_list else [],
+             }
+
+    def WriteSummary(self, path, summary):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(summary, f, sort_keys=True, indent=4, separators=(',', ': '))
+        os.rename(tmp, path)
+
+    def WriteTextfile(self, path, summary):
+        """
+        Write summary to path in the Prometheus text format.  The file
+        is renamed into place, so the collector never sees half of it.
+        """
+        lines = []
+        def Metric(name, help, kind, samples):
+            name = "ix_server_sync_" + name
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (suffix, labels, value) in samples:
+                if labels:
+                    label_text = "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                                   for (k, v) in labels)
+                else:
+                    label_text = ""
+                lines.append("%s%s%s %s" % (name, suffix, label_text, repr(float(value))))
+
+        counts = summary["Counts"]
+        Metric("last_run_timestamp_seconds", "When the last sync finished.", "gauge",
+               [("", None, summary["Time"])])
+        Metric("last_run_success", "Whether the last sync downloaded everything.", "gauge",
+               [("", None, 1 if summary["Success"] else 0)])
+        Metric("phase_duration_seconds", "Time taken by each phase of the last sync.", "gauge",
+               [("", [("phase", phase.lower())], seconds)
+                for (phase, seconds) in sorted(summary["Phases"].items())])
+        Metric("files", "Files handled by the last sync, by what happened to them.", "gauge",
+               [("", [("kind", name[len("Files"):].lower())], value)
+                for (name, value) in sorted(counts.items()) if name.startswith("Files")])
+        Metric("bytes", "Bytes handled by the last sync, by what happened to them.", "gauge",
+               [("", [("kind", name[len("Bytes"):].lower())], value)
+                for (name, value) in sorted(counts.items()) if name.startswith("Bytes")])
+        Metric("throughput_bytes_per_second", "Bytes fetched per second over the last sync.", "gauge",
+               [("", None, summary["Throughput"])])
+        Metric("retries", "Downloads retried during the last sync.", "gauge",
+               [("", None, summary["Retries"])])
+        Metric("failures", "Files the last sync could not download.", "gauge",
+               [("", None, summary["Failures"])])
+        files = summary["Files"]
+        samples = []
+        for (bound, count) in files["Buckets"]:
+            samples.append(("_bucket", [("le", repr(float(bound)))], count))
+        samples.append(("_bucket", [("le", "+Inf")], files["Count"]))
+        samples.append(("_sum", None, files["Seconds"]))
+        samples.append(("_count", None, files["Count"]))
+        Metric("file_download_seconds", "Time taken to download each file in the last sync.", "histogram",
+               samples)
+        for (key, name, help) in (("Requests", "mirror_requests", "Requests made to each mirror."),
+                                  ("FailedRequests", "mirror_failed_requests", "Failed requests to each mirror."),
+                                  ("Bytes", "mirror_bytes", "Bytes fetched from each mirror."),
+                                  ("Throughput", "mirror_throughput_bytes_per_second",
+                                   "Average throughput of each mirror."),
+                                  ("Up", "mirror_up", "Whether each mirror was still in use at the end.")):
+            Metric(name, help, "gauge",
+                   [("", [("mirror", mirror["URL"])], mirror[key] or 0)
+                    for mirror in summary["Mirrors"]])
+
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(tmp, path)
+
+class SyncProgress(object):
+    """
+    Keeps path (JSON) up to date, every INTERVAL seconds, with how a
+    running sync is getting on, so that something else (custard's menu)
+    can show it:  the phase, the files and bytes done and still to do,
+    the current throughput, overall and for each mirror, an estimate of
+    the time left, and the transfers in progress.
+    The downloads report to it through Queued() and Done() (from the
+    download pool), and StartTransfer(), Transferred() and EndTransfer()
+    (from the code moving the bytes).
+    If callback is given, it is told as well (see Syncer); path may
+    then be None, to only do that.
+    """
+    INTERVAL = 1.0
+    # How much each new throughput sample counts for
+    ALPHA = 0.3
+
+    def __init__(self, path, callback=None):
+        self.path = path
+        self.callback = callback
+        self.phase = "Starting"
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._files_done = 0
+        self._files_failed = 0
+        self._bytes_done = 0
+        self._transfers = {}
+        self._transfer_id = 0
+        self._last = None
+        self._rates = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def Notify(self, event, info):
+        if self.callback:
+            try:
+                self.callback(event, info)
+            except Exception as e:
+                print("Progress callback failed for %s: %s" % (event, str(e)), file=sync_log)
+
+    def SetPhase(self, phase):
+        self.phase = phase
+        self.Notify("phase", { "Phase" : phase })
+
+    def Queued(self, out, size):
+        with self._lock:
+            self._sizes[out] = size or 0
+
+    def Done(self, path, out, failed=False):
+        with self._lock:
+            if failed:
+                self._files_failed += 1
+            else:
+                self._files_done += 1
+                self._bytes_done += self._sizes.get(out, 0)
+        self.Notify("file", { "Path" : path, "Output" : out, "Failed" : failed })
+
+    def StartTransfer(self, path, base_url, size=None, offset=0):
+        with self._lock:
+            self._transfer_id += 1
+            self._transfers[self._transfer_id] = { "Path" : path,
+                                                   "Mirror" : base_url,
+                                                   "Size" : size,
+                                                   "Offset" : offset,
+                                                   "Bytes" : 0,
+                                                   "Started" : time.time(),
+                                               }
+            return self._transfer_id
+
+    def Transferred(self, transfer, nbytes):
+        with self._lock:
+            if transfer in self._transfers:
+                self._transfers[transfer]["Bytes"] += nbytes
+
+    def EndTransfer(self, transfer):
+        with self._lock:
+            self._transfers.pop(transfer, None)
+
+    def _Snapshot(self, state):
+        now = time.time()
+        mirrors = GetMirrors().Summary() if url_list else []
+        with self._lock:
+            transfers = [dict(t) for t in self._transfers.values()]
+            files_total = len(self._sizes)
+            files_done = self._files_done
+            files_failed = self._files_failed
+            bytes_total = sum(self._sizes.values())
+            bytes_done = self._bytes_done
+        # What each mirror has sent:  finished transfers, and so far
+        # for the ones in progress.
+        moved = {}
+        for mirror in mirrors:
+            moved[mirror["URL"]] = mirror["Bytes"]
+        for transfer in transfers:
+            moved[transfer["Mirror"]] = moved.get(transfer["Mirror"], 0) + transfer["Bytes"]
+        if self._last:
+            (then, before) = self._last
+            if now > then:
+                for (url, nbytes) in moved.items():
+                    rate = max(0.0, (nbytes - before.get(url, 0)) / (now - then))
+                    old = self._rates.get(url)
+                    self._rates[url] = rate if old is None else old + self.ALPHA * (rate - old)
+        self._last = (now, moved)
+        throughput = sum(self._rates.values())
+        in_flight = sum(t["Bytes"] for t in transfers)
+        remaining = max(0, bytes_total - bytes_done - in_flight)
+        return { "PID" : os.getpid(),
+                 "State" : state,
+                 "Phase" : self.phase,
+                 "Started" : self.started,
+                 "Updated" : now,
+                 "Files" : { "Total" : files_total,
+                             "Done" : files_done,
+                             "Failed" : files_failed,
+                             "Remaining" : files_total - files_done - files_failed,
+                         },
+                 "Bytes" : { "Total" : bytes_total,
+                             "Done" : bytes_done + in_flight,
+                             "Remaining" : remaining,
+                         },
+                 "Throughput" : throughput,
+                 "ETA" : remaining / throughput if throughput > 0 and state == "running" else None,
+                 "Mirrors" : [{ "URL" : mirror["URL"],
+                                "Throughput" : self._rates.get(mirror["URL"], 0.0),
+                                "Requests" : mirror["Requests"],
+                                "Up" : mirror["Up"],
+                            } for mirror in mirrors],
+                 "Transfers" : sorted(transfers, key=lambda t: t["Started"]),
+             }
+
+    def Write(self, state="running"):
+        snapshot = self._Snapshot(state)
+        if self.path:
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(snapshot, f, sort_keys=True)
+                os.rename(tmp, self.path)
+            except (IOError, OSError) as e:
+                if debug or verbose:
+                    print("Could not write progress to %s: %s" % (self.path, str(e)), file=sync_log)
+        self.Notify("progress", snapshot)
+
+    def Start(self):
+        def Run():
+            while not self._stop.wait(self.INTERVAL):
+                self.Write()
+        self.Write()
+        self._thread = threading.Thread(target=Run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Stop(self, state):
+        """
+        Stop the updates, and record the final state
+        ("finished" or "failed").
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.SetPhase("Done")
+        self.Write(state)
+
+def TransferStarted(path, base_url, size=None, offset=0):
+    """
+    Tell sync_progress (if there is one) about a transfer that is
+    starting; returns what to pass to TransferProgress() and TransferEnded().
+    """
+    if sync_progress:
+        return sync_progress.StartTransfer(path, base_url, size, offset)
+    return None
+
+def TransferProgress(transfer, nbytes):
+    if transfer is not None and sync_progress:
+        sync_progress.Transferred(transfer, nbytes)
+
+def TransferEnded(transfer):
+    if transfer is not None and sync_progress:
+        sync_progress.EndTransfer(transfer)
+
+def ConditionalHeaders(local):
+    """
+    Return the headers for a conditional request for a file we
+    already have a complete copy of at local, based on the validators
+    in the index.  Returns an empty dictionary if we can't make one.
+    """
+    if not local or not file_index or not file_index.IsComplete(local):
+        return {}
+    entry = file_index.Lookup(local)
+    retval = {}
+    if entry.get("ETag"):
+        retval["If-None-Match"] = entry["ETag"]
+    if entry.get("LastModified"):
+        retval["If-Modified-Since"] = entry["LastModified"]
+    return retval
+
+class MirrorManager(object):
+    """
+    Keeps track of how each mirror in url_list is doing:  a running
+    average of its latency (time to the response headers) and of its
+    throughput, and how many times in a row it has failed.  A mirror
+    that fails FAILURE_LIMIT times in a row (connection errors, timeouts,
+    or 5xx responses; a 404 is not the mirror's fault) is not used again
+    for the rest of the run, unless every mirror is broken; then they
+    are all tried anyway, since a file that is being retried (see
+    DownloadPool) has nowhere else to go.
+    Ordered() returns the healthy mirrors best first; mirrors whose scores
+    are within SCORE_BUCKET of each other are considered equal, and then
+    the order in url_list decides.
+    """
+    FAILURE_LIMIT = 3
+    ALPHA = 0.3
+    SCORE_BUCKET = 1.25
+    # Used to turn throughput into time, for the score
+    TYPICAL_SIZE = 1024 * 1024
+
+    def __init__(self, urls):
+        self._lock = threading.Lock()
+        self._mirrors = []
+        for (order, url) in enumerate(urls):
+            self._mirrors.append({ "URL" : url,
+                                   "Order" : order,
+                                   "Latency" : None,
+                                   "Throughput" : None,
+                                   "Failures" : 0,
+                                   "Broken" : False,
+                                   "Requests" : 0,
+                                   "FailedRequests" : 0,
+                                   "Bytes" : 0,
+                               })
+
+    def _Find(self, url):
+        for mirror in self._mirrors:
+            if mirror["URL"] == url:
+                return mirror
+        return None
+
+    def _Average(self, old, new):
+        if old is None:
+            return new
+        return old + self.ALPHA * (new - old)
+
+    def _Score(self, mirror):
+        # The expected time, in milliseconds, for a typical file
+        score = 0.0
+        if mirror["Latency"] is not None:
+            score += mirror["Latency"] * 1000
+        if mirror["Throughput"]:
+            score += self.TYPICAL_SIZE * 1000.0 / mirror["Throughput"]
+        return int(math.log(1 + score, self.SCORE_BUCKET))
+
+    def Ordered(self):
+        """
+        Return the URLs of the healthy mirrors, best first
+        (or of all the mirrors, if none of them are healthy).
+        """
+        with self._lock:
+            healthy = [m for m in self._mirrors if not m["Broken"]]
+            if not healthy:
+                healthy = list(self._mirrors)
+            healthy.sort(key=lambda m: (self._Score(m), m["Order"]))
+            return [m["URL"] for m in healthy]
+
+    def RecordSuccess(self, url, latency):
+        with self._lock:
+            mirror = self._Find(url)
+            if mirror:
+                mirror["Requests"] += 1
+                mirror["Failures"] = 0
+                mirror["Latency"] = self._Average(mirror["Latency"], latency)
+
+    def RecordThroughput(self, url, nbytes, seconds):
+        with self._lock:
+            mirror = self._Find(url)
+            if mirror:
+                mirror["Bytes"] += nbytes
+            # Small transfers are all latency, so they say nothing about this
+            if mirror and nbytes >= 64 * 1024 and seconds > 0:
+                mirror["Throughput"] = self._Average(mirror["Throughput"], nbytes / seconds)
+
+    def RecordFailure(self, url):
+        with self._lock:
+            mirror = self._Find(url)
+            if mirror:
+                mirror["Requests"] += 1
+                mirror["FailedRequests"] += 1
+                mirror["Failures"] += 1
+                if mirror["Failures"] >= self.FAILURE_LIMIT and not mirror["Broken"]:
+                    mirror["Broken"] = True
+                    print("Not using %s for the rest of this run" % url, file=sync_log)
+
+    def NewRun(self):
+        """
+        Forget the failures and counts from the last run, but not
+        how fast each mirror is; for a Syncer that is used again.
+        """
+        with self._lock:
+            for mirror in self._mirrors:
+                mirror.update(Failures=0, Broken=False, Requests=0,
+                              FailedRequests=0, Bytes=0)
+
+    def Summary(self):
+        """
+        Return a copy of what we know about each mirror.
+        """
+        with self._lock:
+            retval = []
+            for mirror in self._mirrors:
+                mirror = dict(mirror)
+                mirror["Up"] = not mirror["Broken"]
+                retval.append(mirror)
+            return retval
+
+    def Probe(self, path="", timeout=10):
+        """
+        Measure the latency of every mirror at once, with a HEAD
+        request for path.  Any HTTP response will do; a mirror that
+        can't be reached at all is marked as broken right away, so
+        that no file has to wait for it to time out.
+        """
+        def ProbeOne(url):
+            parts = urlsplit(url)
+            conn = ConnectionPool(url, timeout=timeout)._Connect()
+            started = time.time()
+            try:
+                conn.request("HEAD", parts.path.rstrip("/") + "/" + path,
+                             headers={ "User-Agent" : "ix-server-sync=%s" % Version })
+                conn.getresponse().read()
+                self.RecordSuccess(url, time.time() - started)
+            except BaseException as e:
+                if debug or verbose:
+                    print("Probe of %s failed: %s" % (url, str(e)), file=sync_log)
+                with self._lock:
+                    mirror = self._Find(url)
+                    mirror["Failures"] = self.FAILURE_LIMIT
+                    mirror["Broken"] = True
+            finally:
+                conn.close()
+        probes = []
+        for mirror in self._mirrors:
+            probe = threading.Thread(target=ProbeOne, args=(mirror["URL"],))
+            probe.daemon = True
+            probe.start()
+            probes.append(probe)
+        for probe in probes:
+            probe.join()
+        if debug or verbose:
+            for mirror in self.Summary():
+                print("Mirror %s: latency %s, %s" % (mirror["URL"], mirror["Latency"],
+                                                    "broken" if mirror["Broken"] else "healthy"),
+                      file=sync_log)
+
+def GetMirrors():
+    """
+    Return the MirrorManager for url_list, creating it if need be.
+    """
+    global mirror_manager
+    with mirror_manager_lock:
+        if mirror_manager is None:
+            mirror_manager = MirrorManager(url_list)
+        return mirror_manager
+
+def OpenFromMirrors(path, headers, method="GET", prefer=None):
+    """
+    Try each healthy mirror, best first (see MirrorManager), for path.
+    If prefer is one of the healthy mirrors, it is tried first.
+    Returns a tuple of (response, slot, base_url); the caller must
+    close the response, and release the slot once the transfer is
+    finished.  A 416 (range not satisfiable) is raised right away,
+    since that means the file is complete, not that the mirror is
+    missing it.  If no mirror has the file, the last error is raised.
+    """
+    CheckCancelled()
+    error = None
+    mirrors = GetMirrors()
+    ordered = mirrors.Ordered()
+    if prefer in ordered:
+        ordered.remove(prefer)
+        ordered.insert(0, prefer)
+    for base_url in ordered:
+        slot = MirrorSlot(base_url)
+        slot.acquire()
+        started = time.time()
+        try:
+            response = OpenURL(os.path.join(base_url, path), headers, method=method)
+            mirrors.RecordSuccess(base_url, time.time() - started)
+            return (response, slot, base_url)
+        except HTTPError as e:
+            slot.release()
+            if e.code >= 500:
+                mirrors.RecordFailure(base_url)
+            else:
+                mirrors.RecordSuccess(base_url, time.time() - started)
+            if e.code == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+                raise
+            if debug or verbose:
+                print("Got exception trying to fetch %s" % os.path.join(base_url, path), file=sync_log)
+            error = e
+        except BaseException as e:
+            slot.release()
+            mirrors.RecordFailure(base_url)
+            print("Could not get URL %s" % os.path.join(base_url, path), file=sync_log)
+            error = e
+    if error is None:
+        error = IOError("No healthy server to fetch %s from" % path)
+    raise error
+
+def UnsatisfiableSize(content_range):
+    """
+    Return the size of the file from the Content-Range of a 416
+    response ("bytes */<size>"), or None if the server didn't say.
+    """
+    m = re.match(r"bytes\s+\*/(\d+)$", (content_range or "").strip())
+    return int(m.group(1)) if m else None
+
+def GetNetworkFile(path, out=None, resume=False, conditional=False):
+    """
+    Fetch path from the best mirror that has it.
+    If out is None, the contents are returned; otherwise they are
+    written to out, and None is returned.  If resume is set, and out
+    already exists, the download continues where it left off; when the
+    index knows the validators for the partial file, If-Range is used,
+    so that a file that changed upstream is fetched again from the start
+    instead of being spliced onto the old bytes.  If conditional is set,
+    and the index has a complete copy of out, the request is made with
+    If-None-Match/If-Modified-Since, and out is left alone if the server
+    says it has not been modified.
+    """
+    sha = hashlib.sha256()
+    entry = None
     if out and resume:
         try:
             outfile = open(out, "r+b")
             nread = os.fstat(outfile.fileno()).st_size
+            if nread and file_index:
+                entry = file_index.Lookup(out)
+            # Need the hash of what we already have
+            while True:
+                data = outfile.read(1024 * 1024)
+                if not data:
+                    break
+                sha.update(data)
             outfile.seek(nread)
             if debug or verbose:
-                print("Continuing download of %s at %d bytes" % (path, nread), file=sys.stderr)
+                print("Continuing download of %s at %d bytes" % (path, nread), file=sync_log)
         except:
             nread = 0
             outfile = None
@@ -64,213 +1093,2548 @@ def GetNetworkFile(path, out=None, resume=False):
         nread = 0
         outfile = None
         
-    if sys.version_info[0] < 3:
-        from urllib2 import Request, urlopen, HTTPError
-        from httplib import REQUESTED_RANGE_NOT_SATISFIABLE as HTTP_RANGE
-    else:
-        from urllib.request import Request, urlopen
-        from urllib.error import HTTPError
-        from http.client import REQUESTED_RANGE_NOT_SATISFIABLE as HTTP_RANGE
-
     chunk_size = 1024 * 1024
-    furl = None
-    completed = False
-    for base_url in url_list:
-        try:
-            req = Request(os.path.join(base_url, path))
-            req.add_header("User-Agent", "ix-server-sync=%s" % Version)
-            if nread:
-                req.add_header("Range", "bytes=%d-" % nread)
-            furl = urlopen(req, timeout=30)
-        except HTTPError as error:
-            if error.code == HTTP_RANGE:
-                # This means we've reached the end of the file
-                if resume:
-                    completed = True
-                break
+    headers = { "User-Agent" : "ix-server-sync=%s" % Version }
+    if nread:
+        headers["Range"] = "bytes=%d-" % nread
+        if entry and (entry.get("ETag") or entry.get("LastModified")):
+            headers["If-Range"] = entry.get("ETag") or entry.get("LastModified")
+    elif conditional and out:
+        headers.update(ConditionalHeaders(out))
+
+    try:
+        (furl, slot, base_url) = OpenFromMirrors(path, headers)
+    except HTTPError as error:
+        if outfile:
+            outfile.close()
+        if error.code != httplib.REQUESTED_RANGE_NOT_SATISFIABLE or not resume:
+            raise
+        if UnsatisfiableSize((getattr(error, "hdrs", None) or {}).get("Content-Range")) != nread:
+            # Not the end of the file, so what we have can't be trusted; start again
             if debug or verbose:
-                print("Got exception trying to fetch %s" % os.path.join(base_url, path), file=sys.stderr)
-            continue
-        except BaseException as e:
-            print("Could not get URL %s" % os.path.join(base_url, path), file=sys.stderr)
-        if furl or completed:
-            break
-    if completed:
+                print("Restarting download of %s" % path, file=sync_log)
+            open(out, "wb").close()
+            if file_index:
+                file_index.Forget(out)
+            return GetNetworkFile(path, out, resume=resume)
+        # This means we've reached the end of the file
+        CountMetric("FilesResumed")
+        CountMetric("BytesResumed", nread)
+        if file_index:
+            validators = {}
+            if entry:
+                validators = dict((k, entry[k]) for k in ("ETag", "LastModified") if k in entry)
+            file_index.Record(out, Size=nread, SHA256=sha.hexdigest(),
+                              Complete=True, **validators)
         return None
-    if not furl and not completed:
+    except:
+        if outfile:
+            outfile.close()
         raise
 
+    if furl.code == httplib.NOT_MODIFIED:
+        if debug or verbose:
+            print("%s has not changed" % path, file=sync_log)
+        if out:
+            CountMetric("FilesNotModified")
+        furl.read()
+        furl.close()
+        slot.release()
+        return None
+
     if verbose:
         if out:
-            print("Fetching %s -> %s" % (os.path.join(base_url, path), out), file=sys.stderr)
+            print("Fetching %s -> %s" % (os.path.join(base_url, path), out), file=sync_log)
         else:
-            print("Fetching %s" % (os.path.join(base_url, path)), file=sys.stderr)
+            print("Fetching %s" % (os.path.join(base_url, path)), file=sync_log)
 
     if out is None:
-        retval = furl.read()
+        try:
+            retval = furl.read()
+        finally:
+            furl.close()
+            slot.release()
         return retval
     else:
+        validators = ResponseValidators(furl)
+        expected = furl.getheader("Content-Length")
+        if nread and furl.code != httplib.PARTIAL_CONTENT:
+            # Either the file changed upstream (If-Range), or the
+            # server ignored the Range; either way, start over.
+            if debug or verbose:
+                print("Restarting download of %s" % path, file=sync_log)
+            outfile.seek(0)
+            outfile.truncate()
+            nread = 0
+            sha = hashlib.sha256()
+        resumed = nread
         if outfile is None:
             outfile = open(out, "wb")
+        if file_index:
+            file_index.Record(out, Complete=False, **validators)
+        started = time.time()
+        transfer = TransferStarted(path, base_url, nread + int(expected) if expected is not None else None, nread)
         try:
+            received = 0
             while True:
                 data = furl.read(chunk_size)
                 nread += len(data)
+                received += len(data)
                 if not data:
                     break
+                sha.update(data)
                 outfile.write(data)
+                TransferProgress(transfer, len(data))
+                Throttle(len(data))
+                CheckCancelled()
+            if expected is not None and int(expected) != received:
+                raise IOError("Short read for %s: got %d of %s bytes" % (path, received, expected))
         except:
             if not resume:
                 os.remove(out)
-            else:
-                print("Unable to complete download of file %s" % path, file=sys.stderr)
+                if file_index:
+                    file_index.Forget(out)
+            elif not sync_cancelled.is_set():
+                print("Unable to complete download of file %s" % path, file=sync_log)
             raise
         finally:
             if furl:
                 furl.close()
             if outfile:
                 outfile.close()
+            slot.release()
+            TransferEnded(transfer)
+            CountTransfer(received, time.time() - started)
+            GetMirrors().RecordThroughput(base_url, received, time.time() - started)
+        if file_index:
+            if expected is not None:
+                validators["ContentLength"] = int(expected)
+            file_index.Record(out, Size=nread, SHA256=sha.hexdigest(),
+                              Complete=True, **validators)
+        CountMetric("FilesFetched")
+        if resumed:
+            CountMetric("FilesResumed")
+            CountMetric("BytesResumed", resumed)
     return None
 
-def GetTrains(trains_data):
+def GetMetadataFile(path, local=None, require=None):
     """
-    Return a list of trains for the given project.
+    Fetch a small metadata file (such as trains.txt or LATEST) into
+    memory.  If we have a complete copy at local, a conditional request
+    is made.  require is a dictionary of fields the index entry for local
+    must match for the copy to be trusted (e.g., whether it was fetched
+    for a deep sync).
+    Returns a tuple of (data, validators, changed); if the server says
+    the file has not been modified, data is the contents of local, and
+    changed is False.  Nothing is written; use SaveMetadataFile() for that.
     """
-    retval = []
-    
-    for train in trains_data.split("\n"):
-        tmp = train.split()
-        if tmp:
-            retval.append(tmp[0])
-
-    return retval
+    headers = { "User-Agent" : "ix-server-sync=%s" % Version }
+    if local:
+        cond = ConditionalHeaders(local)
+        entry = file_index.Lookup(local) if cond else None
+        for key in (require or {}).keys():
+            if entry is None or entry.get(key) != require[key]:
+                cond = {}
+        headers.update(cond)
+    started = time.time()
+    (furl, slot, base_url) = OpenFromMirrors(path, headers)
+    try:
+        validators = ResponseValidators(furl)
+        data = furl.read()
+        changed = furl.code != httplib.NOT_MODIFIED
+    finally:
+        furl.close()
+        slot.release()
+    CountTransfer(len(data), time.time() - started)
+    if not changed:
+        if debug or verbose:
+            print("%s has not changed" % path, file=sync_log)
+        with open(local, "rb") as f:
+            data = f.read()
+    elif verbose:
+        print("Fetching %s" % (os.path.join(base_url, path)), file=sync_log)
+    return (data, validators, changed)
 
-def GetLatest(project, train):
+def RemoteFileSize(path):
     """
-    Return the LATEST file for the given project/train.
-    Note that this returns the contents of the file, so it
-    can be written out.
+    Return the size of path on the server, using a HEAD request,
+    or None if it can't be found out.
     """
+    headers = { "User-Agent" : "ix-server-sync=%s" % Version }
     try:
-        latest_data = GetNetworkFile(os.path.join(project, train, "LATEST"))
+        (furl, slot, base_url) = OpenFromMirrors(path, headers, method="HEAD")
     except BaseException as e:
-        # If the trains.txt file is out of date, we can
-        # get not-founds for this train.  So just log it and continue
         if debug or verbose:
-            print("Got exception %s trying to get %s/%s/LATEST" % (str(e), project, train), file=sys.stderr)
-        latest_data = None
-    return latest_data
+            print("Could not get size of %s: %s" % (path, str(e)), file=sync_log)
+        return None
+    try:
+        furl.read()
+        size = furl.getheader("Content-Length")
+    finally:
+        furl.close()
+        slot.release()
+    return int(size) if size is not None else None
 
-def IterateManifestComponents(manifest, deep=False):
+def SaveMetadataFile(local, data, validators, **kwargs):
     """
-    Iterate through a manifest (as a dictionary), yielding the filenames related
-    to it.
+    Write out a file fetched with GetMetadataFile(), and record
+    it (along with any extra fields in kwargs) in the index.
     """
-    if manifest:
-        train = manifest["Train"]
-        if "Notes" in manifest:
-            notes = manifest["Notes"]
-            for note_file in notes.itervalues():
-                yield os.path.join(train, "Notes", note_file)
-        for checker in ["InstallCheckProrgam", "UpdateCheckProgram"]:
-            if checker in manifest:
-                update_check = manifest[checker]
-                yield os.path.join("Validators", update_check["Name"])
-        if "Packages" in manifest:
-            pkgs = manifest["Packages"]
-            for pkg in pkgs:
-                yield "Packages/%s-%s.tgz" % (pkg["Name"], pkg["Version"])
-                if deep and "Upgrades" in pkg:
-                    for upgrade in pkg["Upgrades"]:
-                        yield "Packages/%s-%s-%s.tgz" % (
-                            pkg["Name"],
-                            upgrade["Version"],
-                            pkg["Version"])
+    dirname = os.path.dirname(local)
+    try:
+        os.makedirs(dirname)
+    except:
+        pass
+    tmp = local + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.rename(tmp, local)
+    if file_index:
+        file_index.Record(local, Size=len(data), Complete=True,
+                          SHA256=hashlib.sha256(data).hexdigest(),
+                          **dict(validators, **kwargs))
 
-def GetProject(project, destination, train=None, current_files=None, deep=False):
+def ParseSize(text):
     """
-    Get all of the LATEST for project.
-    If train is set, then only get for that train
+    Turn a size such as "512", "64k", "100M" or "2G" into a number of
+    bytes.  Raises ValueError if it doesn't look like one.
     """
+    text = text.strip()
+    multipliers = { "K" : 1024, "M" : 1024 * 1024, "G" : 1024 * 1024 * 1024 }
+    if text and text[-1].upper() in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1].upper()])
+    return int(text)
 
-    if train is None:
-        train_data = GetNetworkFile(os.path.join(project, "trains.txt"))
-        if destination:
-            # trains.txt is small, and may change, so we always over-write it.
-            try:
-                os.makedirs(destination)
-            except:
-                pass
-            with open(os.path.join(destination, "trains.txt"), "w") as f:
-                f.write(train_data)
-        trains = GetTrains(train_data)
-    else:
-        trains = train
-
-    if current_files is None:
-        curset = {}
-    else:
-        curset = current_files
+def ParseSchedule(text):
+    """
+    Parse a bandwidth schedule, which is a comma-separated list of
+    "HH:MM-HH:MM=rate" windows (a window may wrap past midnight), or
+    just a rate, which applies all day.  Rates are in bytes per second,
+    as understood by ParseSize(); 0 means no limit.
+    Returns a list of (start, end, rate) tuples, with the times
+    in minutes after midnight.  Raises ValueError for bad input.
+    """
+    def Minutes(hhmm):
+        (hours, minutes) = hhmm.split(":")
+        if not (0 <= int(hours) <= 24 and 0 <= int(minutes) < 60):
+            raise ValueError("Invalid time %s" % hhmm)
+        return (int(hours) * 60 + int(minutes)) % (24 * 60)
 
-    for t in trains:
-        manifest_data = GetLatest(project, t)
-        if not manifest_data:
-            print("Could not get sane manifest for %s/%s" % (project, t), file=sys.stderr)
+    retval = []
+    for window in text.split(","):
+        window = window.strip()
+        if not window:
             continue
+        if "=" in window:
+            (times, rate) = window.split("=", 1)
+            (start, end) = times.split("-", 1)
+            retval.append((Minutes(start), Minutes(end), ParseSize(rate)))
+        else:
+            retval.append((0, 24 * 60, ParseSize(window)))
+    return retval
+
+class RateLimiter(object):
+    """
+    A token bucket, shared by every download, that holds the total
+    download rate to the limit the schedule (see ParseSchedule())
+    gives for the current time of day.  Consume() is called after
+    each block is read, and sleeps for as long as it takes for the
+    bucket to pay off the debt; the bucket holds at most one
+    second's worth of tokens, so short bursts are allowed.
+    """
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.time()
+
+    def Rate(self, now=None):
+        """
+        Return the limit in force at now (the current time by
+        default), in bytes per second; 0 means no limit.
+        """
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for (start, end, rate) in self.schedule:
+            if start < end and start <= minute < end:
+                return rate
+            if start >= end and (minute >= start or minute < end):
+                return rate
+        return 0
+
+    def Consume(self, nbytes):
+        rate = self.Rate()
+        with self._lock:
+            now = time.time()
+            if not rate:
+                self._tokens = 0.0
+                self._last = now
+                return
+            self._tokens = min(float(rate), self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= nbytes
+            delay = -self._tokens / rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+def Throttle(nbytes):
+    if rate_limiter:
+        rate_limiter.Consume(nbytes)
+
+def FileChecksum(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+def GetSegmentedFile(path, out, size, checksum=None, segments=None):
+    """
+    Fetch path, which is size bytes long, into out as several byte ranges
+    at once, each one from a different mirror where there is more than
+    one healthy mirror.  The ranges are written straight into their place
+    in out + ".part", which is only renamed to out once they are all
+    done, and the SHA-256 checksum (if we have one from the manifest)
+    has been checked; until then, out would look like a complete file
+    to a resumed download.
+    If a range fails, the part file is cut back to the part at the start
+    that is complete, and moved to out, recorded as partial, so that the
+    next attempt can resume it as usual; the error is then raised.
+    """
+    if segments is None:
+        segments = max_segments
+    segment_size = (size + segments - 1) // segments
+    ranges = []
+    for start in range(0, size, segment_size):
+        ranges.append([start, min(size, start + segment_size) - 1, 0])
+    mirrors = GetMirrors().Ordered()
+    errors = []
+    validators = {}
+    lock = threading.Lock()
+    part = out + ".part"
+
+    with open(part, "wb") as f:
+        f.truncate(size)
+
+    def FetchRange(index):
+        (start, end, done) = ranges[index]
+        prefer = mirrors[index % len(mirrors)] if mirrors else None
+        headers = { "User-Agent" : "ix-server-sync=%s" % Version,
+                    "Range" : "bytes=%d-%d" % (start, end) }
         try:
-            manifest = json.loads(manifest_data)
+            (furl, slot, base_url) = OpenFromMirrors(path, headers, prefer=prefer)
         except BaseException as e:
-            print("Could not load JSON from manifest %s/%s/LATEST: %s" % (project, t, str(e)), file=sys.stderr)
-            continue
-        for file in IterateManifestComponents(manifest, deep=deep):
-            resumable = False
-            if file.startswith("Packages/"):
-                resumable = True
-            if os.path.exists(os.path.join(destination, file)) and not resumable:
-                if debug or verbose:
-                    print("Not downloading %s because it already exists" % file, file=sys.stderr)
-                try:
-                    curset.pop(os.path.join(destination, file))
-                except:
-                    pass
-            else:
-                dirname = os.path.dirname(os.path.join(destination, file))
-                try:
-                    os.makedirs(dirname)
-                except BaseException as e:
-                    if debug:
-                        print("Did not mkdir %s: %s" % (dirname, str(e)), file=sys.stderr)
-                if debug:
-                    print("Downloading SERVER/%s -> %s" % (os.path.join(project, file),
-                                                           os.path.join(destination, file)),
-                          file=sys.stderr)
+            with lock:
+                errors.append(e)
+            return
+        started = time.time()
+        transfer = TransferStarted("%s (bytes %d-%d)" % (path, start, end), base_url, end + 1 - start)
+        try:
+            content_range = furl.getheader("Content-Range") or ""
+            if furl.code != httplib.PARTIAL_CONTENT or not content_range.startswith("bytes %d-" % start):
+                raise IOError("%s did not honour the range for %s" % (base_url, path))
+            if index == 0:
+                validators.update(ResponseValidators(furl))
+            with open(part, "r+b") as f:
+                f.seek(start)
+                while start + ranges[index][2] <= end:
+                    data = furl.read(min(1024 * 1024, end + 1 - start - ranges[index][2]))
+                    if not data:
+                        break
+                    f.write(data)
+                    ranges[index][2] += len(data)
+                    TransferProgress(transfer, len(data))
+                    Throttle(len(data))
+                    CheckCancelled()
+            if start + ranges[index][2] != end + 1:
+                raise IOError("Short read for range %d-%d of %s" % (start, end, path))
+        except BaseException as e:
+            with lock:
+                errors.append(e)
+        finally:
+            furl.close()
+            slot.release()
+            TransferEnded(transfer)
+            CountTransfer(ranges[index][2], time.time() - started)
+            GetMirrors().RecordThroughput(base_url, ranges[index][2], time.time() - started)
+
+    if verbose:
+        print("Fetching %s -> %s in %d segments" % (path, out, len(ranges)), file=sync_log)
+    threads = []
+    for index in range(len(ranges)):
+        thread = threading.Thread(target=FetchRange, args=(index,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        # Keep what we can resume from
+        prefix = 0
+        for (start, end, done) in ranges:
+            prefix += done
+            if start + done != end + 1:
+                break
+        with open(part, "r+b") as f:
+            f.truncate(prefix)
+        os.rename(part, out)
+        if file_index:
+            file_index.Record(out, Complete=False, Size=prefix, **validators)
+        raise errors[0]
+
+    sha = FileChecksum(part)
+    if checksum and sha != checksum.lower():
+        os.remove(part)
+        if file_index:
+            file_index.Forget(out)
+        raise IOError("Checksum mismatch for %s" % path)
+    os.rename(part, out)
+    if file_index:
+        file_index.Record(out, Size=size, SHA256=sha, Complete=True,
+                          ContentLength=size, **validators)
+    CountMetric("FilesFetched")
+
+class BlobStore(object):
+    """
+    A content-addressed store of package files, shared by all of the
+    projects in the destination:  each blob is kept as
+    path/<first two hex digits>/<SHA-256>, and is a hard link to every
+    file in the tree that has the same contents, so it takes no space
+    of its own.  FreeNAS and TrueNAS often ship byte-identical packages
+    under the same name; once either has been downloaded, the other is
+    just linked to it.  Since the files share an inode, nothing may be
+    written into one that has more than one link (see FetchFile()).
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._claims = {}
+
+    def _BlobPath(self, sha):
+        return os.path.join(self.path, sha[:2], sha)
+
+    def Has(self, sha):
+        return os.path.exists(self._BlobPath(sha.lower()))
+
+    def Claim(self, sha):
+        """
+        Return a lock for sha, so that only one thread at a
+        time fetches (or links) any given blob.
+        """
+        with self._lock:
+            return self._claims.setdefault(sha.lower(), threading.Lock())
+
+    def Link(self, sha, out):
+        """
+        If the blob for sha exists, make out a link to it, and
+        return True.  Otherwise (or if it can't be linked), return
+        False, and out is left alone.
+        """
+        blob = self._BlobPath(sha.lower())
+        if not os.path.exists(blob):
+            return False
+        tmp = out + ".link"
+        try:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            os.link(blob, tmp)
+            os.rename(tmp, out)
+        except OSError as e:
+            if debug or verbose:
+                print("Could not link %s to %s: %s" % (out, blob, str(e)), file=sync_log)
+            return False
+        if file_index:
+            entry = file_index.Lookup(blob) or {}
+            fields = dict((k, v) for (k, v) in entry.items() if k != "Path")
+            fields.update(Size=os.path.getsize(out), SHA256=sha.lower(), Complete=True)
+            file_index.Record(out, **fields)
+        if debug or verbose:
+            print("Linked %s to %s" % (out, blob), file=sync_log)
+        CountMetric("FilesLinked")
+        CountMetric("BytesLinked", os.path.getsize(out))
+        return True
+
+    def Store(self, sha, out):
+        """
+        Add the (complete, verified) file out to the store as sha,
+        unless there is already a blob for it.
+        """
+        blob = self._BlobPath(sha.lower())
+        if os.path.exists(blob):
+            return
+        try:
+            os.makedirs(os.path.dirname(blob))
+        except OSError:
+            pass
+        try:
+            os.link(out, blob)
+        except OSError as e:
+            if e.errno != errno.EEXIST and (debug or verbose):
+                print("Could not store %s as %s: %s" % (out, blob, str(e)), file=sync_log)
+            return
+        if file_index:
+            entry = file_index.Lookup(out) or {}
+            file_index.Record(blob, **dict((k, v) for (k, v) in entry.items() if k != "Path"))
+
+    def Release(self, sha):
+        """
+        Remove the blob for sha if nothing in the tree links to
+        it any more.  Returns the number of bytes that freed.
+        """
+        blob = self._BlobPath(sha.lower())
+        with self.Claim(sha):
+            try:
+                st = os.stat(blob)
+                if st.st_nlink != 1:
+                    return 0
+                os.remove(blob)
+            except OSError:
+                return 0
+        if file_index:
+            file_index.Forget(blob)
+        if debug or verbose:
+            print("rm %s" % blob, file=sync_log)
+        return st.st_size
+
+def BlobKey(checksum):
+    """
+    Return the blob store key for a manifest checksum, or None
+    if it isn't a SHA-256.
+    """
+    if checksum and len(checksum) == 64:
+        return checksum.lower()
+    return None
+
+def UnshareFile(out):
+    """
+    If out shares its inode with the blob store, it must not be
+    written to, so remove it; a new download starts from nothing.
+    """
+    try:
+        if os.stat(out).st_nlink > 1:
+            os.remove(out)
+            if file_index:
+                file_index.Forget(out)
+    except OSError:
+        pass
+
+def VerifyChecksum(path, out, checksum):
+    """
+    Check the download of path to out against checksum (the manifest's
+    SHA-256), using the hash the index has for it.  A mismatch removes
+    out, and raises IOError.
+    """
+    if checksum and len(checksum) == 64 and file_index:
+        entry = file_index.Lookup(out)
+        if entry and entry.get("Complete") and entry.get("SHA256") != checksum.lower():
+            os.remove(out)
+            file_index.Forget(out)
+            raise IOError("Checksum mismatch for %s" % path)
+
+def FetchFile(path, out, resume=False, conditional=False, size=None, checksum=None):
+    """
+    Download path to out, the way that suits it best (see DownloadFile()).
+    If there is a blob store, and the manifest gives a checksum that is
+    already in it, out is linked to that instead of being downloaded;
+    whatever is downloaded is added to the store.
+    """
+    if blob_store is None or conditional:
+        return DownloadFile(path, out, resume, conditional, size, checksum)
+    UnshareFile(out)
+    sha = BlobKey(checksum)
+    if sha is None:
+        DownloadFile(path, out, resume, conditional, size, checksum)
+        entry = file_index.Lookup(out) if file_index else None
+        if entry and entry.get("Complete") and entry.get("SHA256"):
+            blob_store.Store(entry["SHA256"], out)
+        return
+    with blob_store.Claim(sha):
+        if blob_store.Link(sha, out):
+            return
+        DownloadFile(path, out, resume, conditional, size, checksum)
+        blob_store.Store(sha, out)
+
+def DownloadFile(path, out, resume=False, conditional=False, size=None, checksum=None):
+    """
+    Download path to out:  large files that we don't have any of
+    yet are fetched in segments (see GetSegmentedFile()), and
+    everything else with GetNetworkFile().
+    If checksum (the manifest's SHA-256) is given, the result is checked
+    against it.
+    """
+    if (size and size >= segment_threshold and max_segments > 1 and
+        not conditional and not os.path.exists(out)):
+        try:
+            return GetSegmentedFile(path, out, size, checksum)
+        except BaseException as e:
+            print("Segmented download of %s failed (%s), trying a single stream" % (path, str(e)),
+                  file=sync_log)
+    GetNetworkFile(path, out, resume=resume, conditional=conditional)
+    VerifyChecksum(path, out, checksum)
+
+def RetryDelay(attempt):
+    """
+    How long to wait before retrying a download that has failed
+    attempt times.  This is exponential backoff, with the upper half
+    of the delay randomised so that files which failed together
+    don't all come back at the same moment.
+    """
+    delay = min(max_retry_delay, retry_delay * (2 ** (attempt - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def Retryable(error):
+    """
+    Decide whether a failed download is worth trying again.
+    Server errors, timeouts and dropped connections are; a file
+    the server says isn't there, or a full or read-only disk, isn't.
+    """
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code in (408, 429)
+    if isinstance(error, (OSError, IOError)) and getattr(error, "errno", None) in (errno.ENOSPC,
+                                                                                  errno.EACCES,
+                                                                                  errno.EROFS):
+        return False
+    return isinstance(error, (IOError, OSError, socket.error, httplib.HTTPException))
+
+class DownloadFailed(IOError):
+    """
+    Raised by DownloadPool.Wait() when some files could not be
+    downloaded at all.  failures is a list of (path, out, error, attempts).
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super(DownloadFailed, self).__init__("%d file(s) could not be downloaded" % len(failures))
+
+def CallDone(path, out, *callbacks):
+    """
+    Call each of callbacks (skipping any that are None) with out, now
+    that path has been downloaded to it.  The callbacks run on the
+    download pool's threads, so a failure is only logged; the callback
+    has to keep track of it itself if it matters.
+    """
+    for callback in callbacks:
+        if callback is None:
+            continue
+        try:
+            callback(out)
+        except Exception as e:
+            print("Error after downloading %s: %s" % (path, str(e)), file=sync_log)
+
+class DownloadPool(object):
+    """
+    A bounded pool of worker threads, used to download several files
+    at once.  The number of workers is the global concurrency limit;
+    the per-mirror limit is handled by OpenFromMirrors(), via MirrorSlot().
+    A failed download does not stop the others.  If it looks transient
+    (see Retryable()), it is queued again after RetryDelay(), up to
+    max_attempts times; meanwhile the workers carry on with other files.
+    Files that still can't be downloaded are reported by Wait(), once
+    everything queued has been tried, and kept in failures for the run.
+    Files are downloaded lowest priority first, and in the order they
+    were added within a priority.
+    Each output file is only queued once for the life of the pool
+    (which is one sync run), however many trains refer to it, unless
+    its download failed.  If done is given, it is called with the
+    output file each time a download finishes.
+    """
+    def __init__(self, jobs=1, done=None):
+        self._done = done
+        self._queue = queue.PriorityQueue()
+        self._sequence = 0
+        self._queued = set()
+        self._errors = []
+        self._pending = 0
+        self._timers = {}
+        self._lock = threading.Condition()
+        self._workers = []
+        self.failures = []
+        self.retries = 0
+        self._StartWorkers(max(1, jobs))
+
+    def _StartWorkers(self, jobs):
+        for i in range(jobs):
+            worker = threading.Thread(target=self._Worker)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _Worker(self):
+        while True:
+            (priority, sequence, item) = self._queue.get()
+            if item is None:
+                return
+            (path, out, kwargs) = item[:3]
+            started = time.time()
+            try:
+                CheckCancelled()
+                FetchFile(path, out, **kwargs)
+            except BaseException as e:
+                self._Outcome(priority, item, e)
+            else:
+                self._Outcome(priority, item, None, started)
+
+    def _Outcome(self, priority, item, error, started=None):
+        """
+        Deal with the end of a download:  retry it, report it, or
+        call the callbacks for it.  started is when the (successful)
+        download began, for the metrics.
+        """
+        (path, out, kwargs, attempt, done, optional) = item
+        if error is None:
+            if sync_metrics and started:
+                sync_metrics.RecordFile(path, time.time() - started)
+        elif not optional and attempt < max_attempts and Retryable(error):
+            delay = RetryDelay(attempt)
+            if debug or verbose:
+                print("Could not download %s (attempt %d): %s; retrying in %.1f seconds" %
+                      (path, attempt, str(error), delay), file=sync_log)
+            self._Retry(priority, (path, out, kwargs, attempt + 1, done, optional), delay)
+            return
+        # Whatever the callbacks do, this download is over, or Wait()
+        # would never return.
+        try:
+            if error is None:
+                CallDone(path, out, self._done, done)
+            elif optional:
+                if debug or verbose:
+                    print("Could not download %s: %s" % (path, str(error)), file=sync_log)
+                with self._lock:
+                    self._queued.discard(out)
+            else:
+                if not isinstance(error, SyncCancelled):
+                    print("Could not download %s: %s" % (path, str(error)), file=sync_log)
+                with self._lock:
+                    self._errors.append((path, out, error, attempt))
+                    self._queued.discard(out)
+            if sync_progress and not isinstance(error, SyncCancelled):
+                sync_progress.Done(path, out, failed=error is not None and not optional)
+        finally:
+            self._Finished()
+
+    def _Put(self, priority, item):
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        self._queue.put((priority, sequence, item))
+
+    def _Retry(self, priority, item, delay):
+        def Requeue():
+            with self._lock:
+                if self._timers.pop(timer, None) is None:
+                    # Cancel() got there first
+                    return
+            self._Put(priority, item)
+        timer = threading.Timer(delay, Requeue)
+        timer.daemon = True
+        with self._lock:
+            self.retries += 1
+            self._timers[timer] = (priority, item)
+        timer.start()
+
+    def _Finished(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending == 0:
+                self._lock.notify_all()
+
+    def Add(self, path, out, priority=0, done=None, optional=False, **kwargs):
+        """
+        Queue path to be downloaded to out; kwargs are passed on
+        to FetchFile().  If done is given, it is called with out
+        once this download has finished.  If optional is set, a
+        failure is only logged; it isn't retried or reported.
+        Returns False if out has already been queued during this run.
+        """
+        with self._lock:
+            if out in self._queued:
+                return False
+            self._queued.add(out)
+            self._pending += 1
+        if sync_progress:
+            sync_progress.Queued(out, kwargs.get("size"))
+        self._Put(priority, (path, out, kwargs, 1, done, optional))
+        return True
+
+    def Wait(self):
+        """
+        Wait for everything queued so far to finish, retries included.
+        Raises DownloadFailed if any of it couldn't be downloaded.
+        """
+        with self._lock:
+            while self._pending:
+                # A timeout, so that ^C still works
+                self._lock.wait(1.0)
+            errors = self._errors
+            self._errors = []
+            self.failures.extend(errors)
+        if errors:
+            raise DownloadFailed(errors)
+
+    def Cancel(self):
+        """
+        Stop waiting to retry anything:  it is all queued again now,
+        so that it fails as cancelled along with everything else.
+        """
+        with self._lock:
+            timers = list(self._timers.items())
+            self._timers.clear()
+        for (timer, (priority, item)) in timers:
+            timer.cancel()
+            self._Put(priority, item)
+
+    def Close(self):
+        """
+        Stop the worker threads, once the queue has drained.
+        Any retries still waiting are abandoned.
+        """
+        with self._lock:
+            timers = list(self._timers)
+            self._timers.clear()
+        for timer in timers:
+            timer.cancel()
+        for worker in self._workers:
+            # After anything that is still queued
+            self._Put(float("inf"), None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+class EventTransfer(object):
+    """
+    The state of one download being done by EventDownloadPool:
+    the request for path, going to each of mirrors in turn until one
+    of them has it, and the response being written to out.
+    """
+    def __init__(self, priority, item):
+        self.priority = priority
+        self.item = item
+        (self.path, self.out, kwargs) = item[:3]
+        self.resume = kwargs.get("resume", False)
+        self.conditional = kwargs.get("conditional", False)
+        self.size = kwargs.get("size")
+        self.checksum = kwargs.get("checksum")
+        self.mirrors = []
+        self.base_url = None
+        self.blob = None
+        self.error = None
+        self.sock = None
+        self.key = None
+        self.reused = False
+        self.state = None
+        self.message = b""
+        self.request = b""
+        self.buffer = b""
+        self.headers = {}
+        self.outfile = None
+        self.sha = hashlib.sha256()
+        self.nread = 0
+        self.entry = None
+        self.code = None
+        self.expected = None
+        self.received = 0
+        self.resumed = 0
+        self.progress = None
+        self.keep_alive = False
+        self.validators = {}
+        self.started = None
+        self.created = self.activity = time.time()
+        self.completed = False
+
+class EventFallBack(Exception):
+    """
+    Raised for a download EventDownloadPool leaves to FetchFile().
+    """
+    pass
+
+class EventDownloadPool(DownloadPool):
+    """
+    A DownloadPool that does the downloads from a single thread,
+    with non-blocking sockets and select(), instead of a thread per
+    download.  It keeps the same limits (max_jobs transfers at once,
+    and, where another mirror has the room, max_mirror_jobs per
+    mirror), the same keep-alive connections,
+    resuming, conditional requests, checksums and blob store, and the
+    same retries, since those are all done by DownloadPool._Outcome().
+    Only plain HTTP is spoken this way.  HTTPS mirrors, redirects,
+    chunked responses, and files big enough to be fetched in segments
+    are handed to FetchFile(), in a thread of their own.
+    """
+    TIMEOUT = 30
+    # New connections that haven't had a response yet; opening many
+    # more at once overflows a server's listen queue.
+    MAX_OPENING = 8
+    CONNECTING, SENDING, HEADERS, BODY = range(4)
+
+    def _StartWorkers(self, jobs):
+        self._jobs = jobs
+        self._ready = []
+        self._active = 0
+        self._mirror_active = {}
+        self._transfers = {}
+        self._idle = {}
+        self._addresses = {}
+        self._blob_waiting = {}
+        self._closing = False
+        (self._wake_read, self._wake_write) = os.pipe()
+        loop = threading.Thread(target=self._Loop)
+        loop.daemon = True
+        loop.start()
+        self._workers.append(loop)
+
+    def _Put(self, priority, item):
+        with self._lock:
+            self._sequence += 1
+            heapq.heappush(self._ready, (priority, self._sequence, item))
+        self._Wake()
+
+    def _Wake(self):
+        try:
+            os.write(self._wake_write, b"x")
+        except OSError:
+            pass
+
+    def Close(self):
+        """
+        Stop the event loop, once the queue has drained.
+        Any retries still waiting are abandoned.
+        """
+        with self._lock:
+            timers = list(self._timers)
+            self._timers.clear()
+            self._closing = True
+        for timer in timers:
+            timer.cancel()
+        self._Wake()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        for idle in self._idle.values():
+            for sock in idle:
+                sock.close()
+        self._idle = {}
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def _Loop(self):
+        while True:
+            opening = len([t for t in self._transfers.values()
+                           if not t.reused and t.state != self.BODY])
+            with self._lock:
+                starting = []
+                while self._ready and self._active < self._jobs and len(starting) + opening < self.MAX_OPENING:
+                    (priority, sequence, item) = heapq.heappop(self._ready)
+                    self._active += 1
+                    starting.append((priority, item))
+                if self._closing and not self._ready and self._active == 0:
+                    return
+            for (priority, item) in starting:
+                self._Start(priority, item)
+            readers = [self._wake_read]
+            writers = []
+            for (sock, transfer) in self._transfers.items():
+                if transfer.state in (self.CONNECTING, self.SENDING):
+                    writers.append(sock)
                 else:
-                    GetNetworkFile(os.path.join(project, file),
-                                   os.path.join(destination, file),
-                                   resume = resumable
-                                   )
-                try:
-                    curset.pop(os.path.join(destination, file))
-                except:
-                    pass
+                    readers.append(sock)
+            try:
+                (readable, writable, _) = select.select(readers, writers, [], 1.0)
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self._wake_read in readable:
+                os.read(self._wake_read, 4096)
+                readable.remove(self._wake_read)
+            for sock in writable:
+                self._Step(sock, self._Writable)
+            for sock in readable:
+                self._Step(sock, self._Readable)
+            now = time.time()
+            for (sock, transfer) in list(self._transfers.items()):
+                if sync_cancelled.is_set():
+                    self._Step(sock, self._Cancelled)
+                elif now - transfer.activity > self.TIMEOUT:
+                    self._Step(sock, self._TimedOut)
+
+    def _Step(self, sock, handler):
+        transfer = self._transfers.get(sock)
+        if transfer is None:
+            return
+        try:
+            handler(transfer)
+        except EventFallBack:
+            self._Detach(transfer, reuse=False)
+            self._Thread(transfer)
+        except BaseException as e:
+            self._Failed(transfer, e)
+
+    def _Start(self, priority, item):
+        """
+        Begin a download:  link it from the blob store if we can,
+        otherwise open the output, and send the request to the first mirror.
+        """
+        transfer = EventTransfer(priority, item)
+        try:
+            CheckCancelled()
+            if (transfer.size and transfer.size >= segment_threshold and max_segments > 1 and
+                not transfer.conditional and not os.path.exists(transfer.out)):
+                raise EventFallBack()
+            if blob_store is not None and not transfer.conditional:
+                UnshareFile(transfer.out)
+                sha = BlobKey(transfer.checksum)
+                with self._lock:
+                    if sha in self._blob_waiting:
+                        # Another transfer is fetching the same blob;
+                        # try again once it has finished.
+                        self._blob_waiting[sha].append((priority, item))
+                        self._active -= 1
+                        return
+                if sha and blob_store.Link(sha, transfer.out):
+                    self._Complete(transfer, None)
+                    return
+                if sha:
+                    with self._lock:
+                        self._blob_waiting[sha] = []
+                    transfer.blob = sha
+            self._Prepare(transfer)
+            transfer.mirrors = GetMirrors().Ordered()
+            self._NextMirror(transfer)
+        except EventFallBack:
+            self._Thread(transfer)
+        except BaseException as e:
+            self._Failed(transfer, e)
 
-            # Need to save manifest as os.path.join(destination, t, "LATEST")
+    def _Prepare(self, transfer):
+        """
+        Work out the request headers, as GetNetworkFile() does.
+        """
+        headers = { "User-Agent" : "ix-server-sync=%s" % Version }
+        if transfer.resume:
             try:
-                os.makedirs(os.path.join(destination, t))
-            except:
+                transfer.outfile = open(transfer.out, "r+b")
+                transfer.nread = os.fstat(transfer.outfile.fileno()).st_size
+                if transfer.nread and file_index:
+                    transfer.entry = file_index.Lookup(transfer.out)
+                while True:
+                    data = transfer.outfile.read(1024 * 1024)
+                    if not data:
+                        break
+                    transfer.sha.update(data)
+                transfer.outfile.seek(transfer.nread)
+                if debug or verbose:
+                    print("Continuing download of %s at %d bytes" % (transfer.path, transfer.nread),
+                          file=sync_log)
+            except (IOError, OSError):
+                transfer.nread = 0
+                transfer.outfile = None
+        entry = transfer.entry
+        if transfer.nread:
+            headers["Range"] = "bytes=%d-" % transfer.nread
+            if entry and (entry.get("ETag") or entry.get("LastModified")):
+                headers["If-Range"] = entry.get("ETag") or entry.get("LastModified")
+        elif transfer.conditional:
+            headers.update(ConditionalHeaders(transfer.out))
+        transfer.headers = headers
+
+    def _NextMirror(self, transfer):
+        """
+        Send the request to the next mirror to try, and skip any at
+        their max_mirror_jobs limit (unless there's nothing else left).
+        Raises the last error if no mirror is left.
+        """
+        while transfer.mirrors:
+            limit = max_mirror_jobs or max_jobs
+            base_url = None
+            for candidate in transfer.mirrors:
+                if self._mirror_active.get(candidate, 0) < limit:
+                    base_url = candidate
+                    break
+            if base_url is None:
+                base_url = transfer.mirrors[0]
+            transfer.mirrors.remove(base_url)
+            parts = urlsplit(base_url)
+            if (parts.scheme or "http") != "http":
+                raise EventFallBack()
+            host = parts.netloc
+            proxy = getproxies().get("http")
+            if proxy and not proxy_bypass(parts.hostname or host):
+                key = urlsplit(proxy).netloc or proxy
+                target = os.path.join(base_url, transfer.path)
+            else:
+                key = host
+                target = os.path.join(parts.path or "/", transfer.path)
+            lines = ["GET %s HTTP/1.1" % target, "Host: %s" % host]
+            lines.extend("%s: %s" % (k, v) for (k, v) in transfer.headers.items())
+            transfer.message = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+            transfer.base_url = base_url
+            transfer.key = key
+            try:
+                self._Connect(transfer)
+            except (IOError, OSError, socket.error) as e:
+                self._MirrorFailed(transfer, e)
+                continue
+            return
+        if transfer.error is None:
+            transfer.error = IOError("No healthy server to fetch %s from" % transfer.path)
+        raise transfer.error
+
+    def _Connect(self, transfer, reuse=True):
+        """
+        Start sending transfer's request, on an idle connection
+        to the server if there is one, otherwise on a new one.
+        """
+        idle = self._idle.get(transfer.key)
+        if reuse and idle:
+            sock = idle.pop()
+            transfer.reused = True
+            transfer.state = self.SENDING
+        else:
+            if transfer.key not in self._addresses:
+                (host, port) = (transfer.key.rsplit(":", 1) + ["80"])[:2]
+                info = socket.getaddrinfo(host.strip("[]"), int(port), 0, socket.SOCK_STREAM)
+                self._addresses[transfer.key] = info[0]
+            (family, socktype, proto, canonname, address) = self._addresses[transfer.key]
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            status = sock.connect_ex(address)
+            if status not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                raise socket.error(status, os.strerror(status))
+            transfer.reused = False
+            transfer.state = self.CONNECTING
+        transfer.sock = sock
+        transfer.request = transfer.message
+        transfer.buffer = b""
+        transfer.started = transfer.activity = time.time()
+        self._transfers[sock] = transfer
+        self._mirror_active[transfer.base_url] = self._mirror_active.get(transfer.base_url, 0) + 1
+
+    def _Detach(self, transfer, reuse):
+        """
+        Take transfer's socket out of the loop, and keep it for the
+        next request to the same server if reuse is set.
+        """
+        TransferEnded(transfer.progress)
+        transfer.progress = None
+        sock = transfer.sock
+        if sock is None:
+            return
+        self._transfers.pop(sock, None)
+        transfer.sock = None
+        self._mirror_active[transfer.base_url] -= 1
+        if reuse:
+            self._idle.setdefault(transfer.key, []).append(sock)
+        else:
+            sock.close()
+
+    def _MirrorFailed(self, transfer, error):
+        """
+        This mirror couldn't give us the file; try the next one.
+        """
+        url = os.path.join(transfer.base_url, transfer.path)
+        if not isinstance(error, HTTPError):
+            print("Could not get URL %s" % url, file=sync_log)
+        elif debug or verbose:
+            print("Got exception trying to fetch %s" % url, file=sync_log)
+        GetMirrors().RecordFailure(transfer.base_url)
+        transfer.error = error
+        self._Detach(transfer, reuse=False)
+        self._NextMirror(transfer)
+
+    def _Writable(self, transfer):
+        if transfer.state == self.CONNECTING:
+            status = transfer.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if status:
+                self._MirrorFailed(transfer, socket.error(status, os.strerror(status)))
+                return
+            transfer.state = self.SENDING
+        try:
+            sent = transfer.sock.send(transfer.request)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._Dropped(transfer, e)
+            return
+        transfer.request = transfer.request[sent:]
+        transfer.activity = time.time()
+        if not transfer.request:
+            transfer.state = self.HEADERS
+
+    def _Dropped(self, transfer, error):
+        """
+        The connection went away before there was a response.  If it was
+        an idle one, the server most likely closed it; use a new one.
+        """
+        if transfer.reused:
+            self._Detach(transfer, reuse=False)
+            try:
+                self._Connect(transfer, reuse=False)
+                return
+            except (IOError, OSError, socket.error) as e:
+                error = e
+        self._MirrorFailed(transfer, error)
+
+    def _Readable(self, transfer):
+        try:
+            data = transfer.sock.recv(256 * 1024)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            if transfer.state == self.HEADERS and not transfer.buffer:
+                self._Dropped(transfer, e)
+                return
+            raise
+        transfer.activity = time.time()
+        if transfer.state == self.HEADERS:
+            if not data:
+                if not transfer.buffer:
+                    self._Dropped(transfer, IOError("Connection closed by %s" % transfer.key))
+                    return
+                raise IOError("Connection closed while reading response for %s" % transfer.path)
+            transfer.buffer += data
+            end = transfer.buffer.find(b"\r\n\r\n")
+            if end < 0:
+                if len(transfer.buffer) > 65536:
+                    raise IOError("Response headers too long for %s" % transfer.path)
+                return
+            data = transfer.buffer[end + 4:]
+            self._Response(transfer, transfer.buffer[:end].decode("latin-1"))
+            if transfer.sock is None or transfer.state != self.BODY or not data:
+                return
+        elif not data:
+            if transfer.expected is None:
+                self._Done(transfer)
+                return
+            raise IOError("Short read for %s: got %d of %s bytes" %
+                          (transfer.path, transfer.received, transfer.expected))
+        transfer.sha.update(data)
+        transfer.outfile.write(data)
+        transfer.nread += len(data)
+        transfer.received += len(data)
+        TransferProgress(transfer.progress, len(data))
+        Throttle(len(data))
+        if transfer.expected is not None and transfer.received >= transfer.expected:
+            if transfer.received > transfer.expected:
+                raise IOError("Long read for %s" % transfer.path)
+            self._Done(transfer)
+
+    def _Response(self, transfer, head):
+        """
+        Deal with the status and headers of a response, as
+        OpenFromMirrors() and GetNetworkFile() do.
+        """
+        lines = head.split("\r\n")
+        status = lines[0].split(None, 2)
+        code = int(status[1])
+        reason = status[2] if len(status) > 2 else ""
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                (name, value) = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        if "chunked" in headers.get("transfer-encoding", "").lower() or 300 <= code < 400 and code != 304:
+            raise EventFallBack()
+        url = os.path.join(transfer.base_url, transfer.path)
+        mirrors = GetMirrors()
+        if code >= 500:
+            self._MirrorFailed(transfer, HTTPError(url, code, reason, None, None))
+            return
+        mirrors.RecordSuccess(transfer.base_url, time.time() - transfer.started)
+        transfer.keep_alive = (status[0] == "HTTP/1.1" and
+                               headers.get("connection", "").lower() != "close")
+        if code == httplib.REQUESTED_RANGE_NOT_SATISFIABLE and transfer.resume:
+            self._Detach(transfer, reuse=False)
+            if UnsatisfiableSize(headers.get("content-range")) != transfer.nread:
+                # Not the end of the file, so what we have can't be trusted; start again
+                if debug or verbose:
+                    print("Restarting download of %s" % transfer.path, file=sync_log)
+                transfer.outfile.seek(0)
+                transfer.outfile.truncate()
+                transfer.outfile.close()
+                transfer.outfile = None
+                transfer.sha = hashlib.sha256()
+                transfer.nread = 0
+                transfer.entry = None
+                if file_index:
+                    file_index.Forget(transfer.out)
+                self._Prepare(transfer)
+                transfer.mirrors.insert(0, transfer.base_url)
+                self._NextMirror(transfer)
+                return
+            # This means we've reached the end of the file
+            CountMetric("FilesResumed")
+            CountMetric("BytesResumed", transfer.nread)
+            if file_index:
+                validators = {}
+                if transfer.entry:
+                    validators = dict((k, transfer.entry[k]) for k in ("ETag", "LastModified")
+                                      if k in transfer.entry)
+                file_index.Record(transfer.out, Size=transfer.nread, SHA256=transfer.sha.hexdigest(),
+                                  Complete=True, **validators)
+            self._Finish(transfer)
+            return
+        if code >= 400:
+            if debug or verbose:
+                print("Got exception trying to fetch %s" % url, file=sync_log)
+            transfer.error = HTTPError(url, code, reason, None, None)
+            self._Detach(transfer, reuse=False)
+            if code == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+                raise transfer.error
+            self._NextMirror(transfer)
+            return
+        if code == httplib.NOT_MODIFIED:
+            if debug or verbose:
+                print("%s has not changed" % transfer.path, file=sync_log)
+            CountMetric("FilesNotModified")
+            self._Detach(transfer, reuse=transfer.keep_alive)
+            self._Finish(transfer)
+            return
+        if verbose:
+            print("Fetching %s -> %s" % (url, transfer.out), file=sync_log)
+        for (header, key) in (("etag", "ETag"), ("last-modified", "LastModified")):
+            if headers.get(header):
+                transfer.validators[key] = headers[header]
+        if "content-length" in headers:
+            transfer.expected = int(headers["content-length"])
+        else:
+            transfer.keep_alive = False
+        if transfer.nread and code != httplib.PARTIAL_CONTENT:
+            # Either the file changed upstream (If-Range), or the
+            # server ignored the Range; either way, start over.
+            if debug or verbose:
+                print("Restarting download of %s" % transfer.path, file=sync_log)
+            transfer.outfile.seek(0)
+            transfer.outfile.truncate()
+            transfer.nread = 0
+            transfer.sha = hashlib.sha256()
+        transfer.resumed = transfer.nread
+        if transfer.outfile is None:
+            transfer.outfile = open(transfer.out, "wb")
+        if file_index:
+            file_index.Record(transfer.out, Complete=False, **transfer.validators)
+        transfer.code = code
+        transfer.started = time.time()
+        transfer.progress = TransferStarted(transfer.path, transfer.base_url,
+                                            transfer.nread + transfer.expected
+                                            if transfer.expected is not None else None,
+                                            transfer.nread)
+        transfer.state = self.BODY
+        if transfer.expected == 0:
+            self._Done(transfer)
+
+    def _Done(self, transfer):
+        """
+        The whole body has arrived.
+        """
+        elapsed = time.time() - transfer.started
+        base_url = transfer.base_url
+        self._Detach(transfer, reuse=transfer.keep_alive)
+        transfer.outfile.close()
+        transfer.outfile = None
+        CountTransfer(transfer.received, elapsed)
+        GetMirrors().RecordThroughput(base_url, transfer.received, elapsed)
+        if file_index:
+            validators = dict(transfer.validators)
+            if transfer.expected is not None:
+                validators["ContentLength"] = transfer.expected
+            file_index.Record(transfer.out, Size=transfer.nread, SHA256=transfer.sha.hexdigest(),
+                              Complete=True, **validators)
+        CountMetric("FilesFetched")
+        if transfer.resumed:
+            CountMetric("FilesResumed")
+            CountMetric("BytesResumed", transfer.resumed)
+        self._Finish(transfer)
+
+    def _Finish(self, transfer):
+        if transfer.outfile:
+            transfer.outfile.close()
+            transfer.outfile = None
+        VerifyChecksum(transfer.path, transfer.out, transfer.checksum)
+        if transfer.blob:
+            blob_store.Store(transfer.blob, transfer.out)
+        self._Complete(transfer, None)
+
+    def _TimedOut(self, transfer):
+        raise socket.timeout("timed out fetching %s" % transfer.path)
+
+    def _Cancelled(self, transfer):
+        CheckCancelled()
+
+    def _Failed(self, transfer, error):
+        """
+        The download failed part way through, or couldn't be started.
+        """
+        self._Detach(transfer, reuse=False)
+        if transfer.outfile:
+            transfer.outfile.close()
+            transfer.outfile = None
+            if transfer.state == self.BODY:
+                if not transfer.resume:
+                    try:
+                        os.remove(transfer.out)
+                    except OSError:
+                        pass
+                    if file_index:
+                        file_index.Forget(transfer.out)
+                elif not sync_cancelled.is_set():
+                    print("Unable to complete download of file %s" % transfer.path, file=sync_log)
+        self._Complete(transfer, error)
+
+    def _Complete(self, transfer, error):
+        if transfer.completed:
+            return
+        transfer.completed = True
+        with self._lock:
+            self._active -= 1
+            waiting = self._blob_waiting.pop(transfer.blob, []) if transfer.blob else []
+        for (priority, item) in waiting:
+            self._Put(priority, item)
+        try:
+            # This counts the download as finished, whatever the
+            # callbacks do (see DownloadPool._Outcome())
+            self._Outcome(transfer.priority, transfer.item, error, transfer.created)
+        finally:
+            self._Wake()
+
+    def _Thread(self, transfer):
+        """
+        Hand a download the loop doesn't do over to FetchFile().
+        """
+        def Run():
+            try:
+                FetchFile(transfer.path, transfer.out, **transfer.item[2])
+            except BaseException as e:
+                self._Complete(transfer, e)
+            else:
+                self._Complete(transfer, None)
+        if transfer.outfile:
+            transfer.outfile.close()
+            transfer.outfile = None
+        thread = threading.Thread(target=Run)
+        thread.daemon = True
+        thread.start()
+
+def NewDownloadPool(jobs, done=None):
+    """
+    Return a download pool of the kind download_engine asks for.
+    """
+    if download_engine == "events":
+        return EventDownloadPool(jobs, done=done)
+    return DownloadPool(jobs, done=done)
+
+def GetTrains(trains_data):
+    """
+    Return a list of trains for the given project.
+    """
+    retval = []
+    
+    for train in trains_data.split("\n"):
+        tmp = train.split()
+        if tmp:
+            retval.append(tmp[0])
+
+    return retval
+
+def RunConcurrently(function, items):
+    """
+    Call function on each of items, each in its own thread, and
+    return the results in the same order as items.  If any of the
+    calls raised an exception, the first one is raised.
+    """
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    def Run(n):
+        try:
+            results[n] = function(items[n])
+        except BaseException as e:
+            errors[n] = e
+    threads = []
+    for n in range(len(items)):
+        thread = threading.Thread(target=Run, args=(n,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+def GetLatest(project, train, local=None, deep=False):
+    """
+    Return the LATEST file for the given project/train.
+    Note that this returns the contents of the file, so it
+    can be written out.  If local is given, it is our copy of
+    the file, and a conditional request is made for it, unless
+    it was synced with a different deep setting (in which case the
+    deltas to fetch, or to drop, have to be worked out again).
+    Returns a tuple of (data, validators, changed); see GetMetadataFile().
+    """
+    try:
+        require = { "Deep" : bool(deep) }
+        return GetMetadataFile(os.path.join(project, train, "LATEST"), local, require=require)
+    except BaseException as e:
+        # If the trains.txt file is out of date, we can
+        # get not-founds for this train.  So just log it and continue
+        if debug or verbose:
+            print("Got exception %s trying to get %s/%s/LATEST" % (str(e), project, train), file=sync_log)
+    return (None, {}, True)
+
+def IterateManifestComponents(manifest, deep=False, checksums=False, wanted=None):
+    """
+    Iterate through a manifest (as a dictionary), yielding the filenames related
+    to it.  If checksums is set, (filename, checksum) tuples are yielded
+    instead; the checksum is None if the manifest does not have one.
+    If deep is set, all of the upgrade deltas are included; otherwise, if
+    wanted is given, the deltas for which wanted(name, old_version) is true.
+    """
+    if manifest:
+        train = manifest["Train"]
+        components = []
+        if "Notes" in manifest:
+            notes = manifest["Notes"]
+            for note_file in notes.values():
+                components.append((os.path.join(train, "Notes", note_file), None))
+        for checker in ["InstallCheckProrgam", "UpdateCheckProgram"]:
+            if checker in manifest:
+                update_check = manifest[checker]
+                components.append((os.path.join("Validators", update_check["Name"]),
+                                   update_check.get("Checksum")))
+        for item in components:
+            yield item if checksums else item[0]
+        if "Packages" in manifest:
+            pkgs = manifest["Packages"]
+            for pkg in pkgs:
+                file = "Packages/%s-%s.tgz" % (pkg["Name"], pkg["Version"])
+                yield (file, pkg.get("Checksum")) if checksums else file
+                if (deep or wanted) and "Upgrades" in pkg:
+                    for upgrade in pkg["Upgrades"]:
+                        if not deep and not wanted(pkg["Name"], upgrade["Version"]):
+                            continue
+                        file = "Packages/%s-%s-%s.tgz" % (
+                            pkg["Name"],
+                            upgrade["Version"],
+                            pkg["Version"])
+                        yield (file, upgrade.get("Checksum")) if checksums else file
+
+class FleetVersions(object):
+    """
+    The package versions our clients are running, so that a deep sync
+    can fetch just the deltas they can use (see IterateManifestComponents()),
+    instead of every one in every manifest.  They come from an explicit
+    list (each entry either a version, meaning that version of any
+    package, or name=version), and from the package requests in nginx
+    access logs:  a client that asked for name-version.tgz, or for a
+    delta from or to a version, is running (or will be) that version.
+    What the logs showed is kept in path, along with how far each log
+    has been read, since logs are rotated; a version that hasn't been
+    seen for MAX_AGE seconds is forgotten.
+    """
+    MAX_AGE = 90 * 24 * 60 * 60
+    REQUEST = re.compile(r'"(?:GET|HEAD) ([^ "?]*/Packages/([^/ "?]+)\.tgz)[^"]*"')
+
+    def __init__(self, path=None, versions=()):
+        self.path = path
+        self._explicit = set(versions)
+        self._seen = {}
+        self._logs = {}
+        if path:
+            try:
+                with open(path, "r") as f:
+                    state = json.load(f)
+                self._seen = state.get("Seen", {})
+                self._logs = state.get("Logs", {})
+            except (IOError, ValueError):
                 pass
-            with open(os.path.join(destination, t, "LATEST"), "w") as latest:
-                latest.write(manifest_data)
+        now = time.time()
+        for (name, seen) in list(self._seen.items()):
+            if now - seen > self.MAX_AGE:
+                del self._seen[name]
+        self._Index()
+
+    def _Index(self):
+        # Package file names can't be split into name and versions on
+        # their own (both may contain "-"), so every possible split is
+        # remembered:  name-version, name-old-new (as both name-old and
+        # name-new).  The occasional impossible split does no harm.
+        self._installed = set()
+        for entry in self._seen:
+            parts = entry.split("-")
+            for i in range(1, len(parts)):
+                name = "-".join(parts[:i])
+                self._installed.add((name, "-".join(parts[i:])))
+                for j in range(i + 1, len(parts)):
+                    self._installed.add((name, "-".join(parts[i:j])))
+                    self._installed.add((name, "-".join(parts[j:])))
+
+    def Learn(self, log_path):
+        """
+        Read any new requests in the nginx access log at log_path.
+        """
+        state = self._logs.get(log_path, {})
+        try:
+            with open(log_path, "rb") as f:
+                st = os.fstat(f.fileno())
+                offset = state.get("Offset", 0)
+                if state.get("Inode") != st.st_ino or st.st_size < offset:
+                    # A new log, since it was rotated
+                    offset = 0
+                f.seek(offset)
+                now = int(time.time())
+                count = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Still being written; next time
+                        break
+                    offset += len(line)
+                    if not isinstance(line, str):
+                        line = line.decode("utf-8", "replace")
+                    match = self.REQUEST.search(line)
+                    if match:
+                        self._seen[match.group(2)] = now
+                        count += 1
+        except IOError as e:
+            print("Could not read access log %s: %s" % (log_path, str(e)), file=sync_log)
+            return
+        self._logs[log_path] = { "Inode" : st.st_ino, "Offset" : offset }
+        if debug or verbose:
+            print("Found %d package requests in %s" % (count, log_path), file=sync_log)
+        self._Index()
+
+    def Save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({ "Seen" : self._seen, "Logs" : self._logs }, f, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def Wants(self, name, version):
+        """
+        Is a delta from version of package name any use to our clients?
+        """
+        return (version in self._explicit or
+                "%s=%s" % (name, version) in self._explicit or
+                (name, version) in self._installed)
+
+def DiffManifests(old, new, old_deep=False, new_deep=False):
+    """
+    Compare two manifests for a train (as dictionaries; old may be None),
+    and return a tuple of (added, removed, changed) lists of filenames.
+    A file is changed if both manifests have it, and the checksums differ;
+    notes and validators usually have no checksum, so they are counted
+    as changed whenever the manifest has changed, to be checked with a
+    conditional request.  Files in both, with the same checksum, are in
+    none of the lists.
+    """
+    old_files = dict(IterateManifestComponents(old, deep=old_deep, checksums=True))
+    new_list = list(IterateManifestComponents(new, deep=new_deep, checksums=True))
+    new_files = dict(new_list)
+    added = []
+    changed = []
+    for (file, checksum) in new_list:
+        if file not in old_files:
+            added.append(file)
+        elif checksum != old_files[file] or (checksum is None and not file.startswith("Packages/")):
+            changed.append(file)
+    removed = [file for file in old_files.keys() if file not in new_files]
+    return (added, removed, changed)
+
+def PreviousManifest(latest_path):
+    """
+    Return a tuple of (manifest, deep) for the last LATEST we completely
+    synced to latest_path, or (None, False) if there isn't one the index
+    knows about.
+    """
+    if not file_index or not file_index.IsComplete(latest_path):
+        return (None, False)
+    entry = file_index.Lookup(latest_path)
+    if "Deep" not in entry:
+        return (None, False)
+    try:
+        with open(latest_path, "r") as f:
+            return (json.load(f), entry["Deep"])
+    except BaseException as e:
+        if debug or verbose:
+            print("Could not load previous manifest %s: %s" % (latest_path, str(e)), file=sync_log)
+    return (None, False)
+
+def ManifestFileSizes(manifest, deep=False):
+    """
+    Return a dictionary mapping the package files in manifest to their
+    sizes, for the ones the manifest gives a size (FileSize) for.
+    """
+    retval = {}
+    if manifest and "Packages" in manifest:
+        for pkg in manifest["Packages"]:
+            size = pkg.get("FileSize", pkg.get("Size"))
+            if size is not None:
+                retval["Packages/%s-%s.tgz" % (pkg["Name"], pkg["Version"])] = int(size)
+            if deep and "Upgrades" in pkg:
+                for upgrade in pkg["Upgrades"]:
+                    size = upgrade.get("FileSize", upgrade.get("Size"))
+                    if size is not None:
+                        retval["Packages/%s-%s-%s.tgz" % (pkg["Name"], upgrade["Version"], pkg["Version"])] = int(size)
+    return retval
+
+# Download priorities; lower numbers are fetched first.  Deltas are
+# PRIORITY_DELTA plus the rank of their source version, newest first.
+PRIORITY_METADATA = 0
+PRIORITY_PACKAGE = 1
+PRIORITY_DELTA = 2
+
+def VersionKey(version):
+    """
+    A sort key for version strings, comparing the numeric parts
+    as numbers (so 11.10 is newer than 11.9).
+    """
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part)
+            for part in re.findall(r"\d+|[^\d.-]+", version)]
+
+def ManifestPriorities(manifest, deep=False):
+    """
+    Return a dictionary mapping the files in manifest to the order
+    they should be downloaded in:  notes and validators first, then
+    the full packages, then the deltas (if deep is set), those from the
+    most recent source versions first.  Everything but the deltas is
+    needed before the manifest can be published.
+    """
+    retval = {}
+    for file in IterateManifestComponents(manifest):
+        if file.startswith("Packages/"):
+            retval[file] = PRIORITY_PACKAGE
+        else:
+            retval[file] = PRIORITY_METADATA
+    if deep and manifest and "Packages" in manifest:
+        for pkg in manifest["Packages"]:
+            upgrades = sorted(pkg.get("Upgrades", []), key=lambda u: VersionKey(u["Version"]), reverse=True)
+            for (rank, upgrade) in enumerate(upgrades):
+                file = "Packages/%s-%s-%s.tgz" % (pkg["Name"], upgrade["Version"], pkg["Version"])
+                retval[file] = min(retval.get(file, PRIORITY_DELTA + rank), PRIORITY_DELTA + rank)
+    return retval
+
+class SyncPlan(object):
+    """
+    The work needed to sync one project into destination.  Building
+    a plan (see PlanProject()) fetches trains.txt and the LATEST files,
+    but writes nothing; ExecutePlan() does the rest.
+    trains	-- the trains being synced
+    downloads	-- (file, resume, conditional, refetch) for each file to
+    		   download; refetch means the file must not be resumed
+    changelogs	-- the trains whose ChangeLog.txt should be refreshed
+    metadata	-- (local, data, validators, extra) for each file to save
+    		   once the downloads are done (trains.txt and LATEST)
+    sizes	-- the sizes the manifests give for files
+    checksums	-- the checksums the manifests give for files
+    priorities	-- the order to download files in (see ManifestPriorities())
+    required	-- for each train, the files that have to be present
+    		   before its LATEST can be saved
+    stale	-- the files that are no longer needed, once this is done
+    All file names are relative to destination.
+    """
+    def __init__(self, project, destination, deep=False):
+        self.project = project
+        self.destination = destination
+        self.deep = deep
+        self.trains = []
+        self.downloads = []
+        self.changelogs = []
+        self.metadata = []
+        self.sizes = {}
+        self.checksums = {}
+        self.priorities = {}
+        self.required = {}
+        self.stale = []
+
+    def ToDict(self):
+        return { "Project" : self.project,
+                 "Destination" : self.destination,
+                 "Deep" : self.deep,
+                 "Trains" : self.trains,
+                 "Downloads" : self.downloads,
+                 "Changelogs" : self.changelogs,
+                 "Metadata" : [(local, data.decode("utf-8") if isinstance(data, bytes) else data,
+                                validators, extra)
+                               for (local, data, validators, extra) in self.metadata],
+                 "Sizes" : self.sizes,
+                 "Checksums" : self.checksums,
+                 "Priorities" : self.priorities,
+                 "Required" : self.required,
+                 "Stale" : self.stale,
+             }
+
+    @staticmethod
+    def FromDict(d):
+        plan = SyncPlan(d["Project"], d["Destination"], d["Deep"])
+        plan.trains = d["Trains"]
+        plan.downloads = [tuple(x) for x in d["Downloads"]]
+        plan.changelogs = d["Changelogs"]
+        plan.metadata = [(local, data.encode("utf-8"), validators, extra)
+                         for (local, data, validators, extra) in d["Metadata"]]
+        plan.sizes = d["Sizes"]
+        plan.checksums = d["Checksums"]
+        plan.priorities = d.get("Priorities", {})
+        plan.required = d.get("Required", {})
+        plan.stale = d["Stale"]
+        return plan
+
+class SyncJournal(object):
+    """
+    A write-ahead journal for sync runs, kept as JSON lines.
+    Each project's plan is written to it before any of it is carried
+    out; each file is noted as it finishes, and the project is noted
+    once its new LATEST files have been saved.  If a run is interrupted,
+    the next one first finishes the plans that were in flight (skipping
+    the files already done), instead of starting over.  The stale files
+    of every plan since the last clean run are carried over, and are
+    only deleted once a run has finished cleanly; Finish() then
+    removes the journal.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.stale = set()
+        self._plans = {}
+        self._done = set()
+        self._lock = threading.Lock()
+        self._log = None
+        # Set if a write failed, and may have left part of a line
+        self._torn = False
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        op = entry["Op"]
+                    except:
+                        # Most likely a partial line from a crash
+                        continue
+                    if op == "Plan":
+                        plan = SyncPlan.FromDict(entry["Plan"])
+                        self._plans[plan.project] = plan
+                        self.stale.update(os.path.join(plan.destination, file) for file in plan.stale)
+                    elif op == "Done":
+                        self._done.add(entry["Path"])
+                    elif op == "Saved":
+                        self._plans.pop(entry["Project"], None)
+                    elif op == "Stale":
+                        self.stale.update(entry["Paths"])
+        except IOError:
+            pass
+
+    def _Append(self, entry):
+        with self._lock:
+            if self._log is None:
+                self._log = open(self.path, "a")
+            line = json.dumps(entry, sort_keys=True) + "\n"
+            if self._torn:
+                line = "\n" + line
+            self._torn = True
+            self._log.write(line)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._torn = False
+
+    def Unfinished(self):
+        """
+        Return the SyncPlans from an interrupted run, without
+        the downloads that had already finished.
+        """
+        retval = []
+        for plan in self._plans.values():
+            plan.downloads = [d for d in plan.downloads
+                              if os.path.join(plan.destination, d[0]) not in self._done]
+            retval.append(plan)
+        return retval
+
+    def Begin(self):
+        """
+        Start a new run:  the journal is rewritten with just what is
+        carried over from the previous one (unfinished plans, and the
+        stale files), and then appended to.
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for plan in self.Unfinished():
+                f.write(json.dumps({ "Op" : "Plan", "Plan" : plan.ToDict() }, sort_keys=True) + "\n")
+            f.write(json.dumps({ "Op" : "Stale", "Paths" : sorted(self.stale) }, sort_keys=True) + "\n")
+        os.rename(tmp, self.path)
+        self._done = set()
+
+    def RecordPlan(self, plan):
+        self._Append({ "Op" : "Plan", "Plan" : plan.ToDict() })
+
+    def RecordDone(self, path):
+        # This is called from the download pool's threads.  Losing
+        # the note only means the file is fetched again if the run is
+        # interrupted, so a full disk or an I/O error isn't fatal.
+        try:
+            self._Append({ "Op" : "Done", "Path" : path })
+        except EnvironmentError as e:
+            print("Could not note %s in %s: %s" % (path, self.path, str(e)), file=sync_log)
+
+    def RecordSaved(self, project):
+        self._Append({ "Op" : "Saved", "Project" : project })
+
+    def Finish(self):
+        """
+        The run finished cleanly, and the stale files are gone.
+        """
+        with self._lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def RetainedManifests(train_dir, keep=None):
+    """
+    Return the paths of the newest keep manifests in train_dir/History
+    (newest first); keep defaults to keep_releases.
+    """
+    if keep is None:
+        keep = keep_releases
+    history = os.path.join(train_dir, "History")
+    try:
+        paths = [os.path.join(history, name) for name in os.listdir(history)
+                 if not name.endswith(".tmp")]
+    except OSError:
+        return []
+    paths.sort(key=lambda path: os.path.getmtime(path), reverse=True)
+    return paths[:max(0, keep)]
+
+def RetainManifest(latest_path, new_data, keep=None):
+    """
+    The LATEST at latest_path is about to be replaced with new_data;
+    if it is different, keep a copy of it in the train's History
+    directory (named for its Sequence), so that clients still on that
+    release can be served locally.  Only the newest keep manifests
+    (keep defaults to keep_releases) are kept; returns the files the
+    ones that were dropped refer to (as full paths), since they may
+    no longer be needed.
+    """
+    if keep is None:
+        keep = keep_releases
+    train_dir = os.path.dirname(latest_path)
+    history = os.path.join(train_dir, "History")
+    retval = []
+    try:
+        with open(latest_path, "rb") as f:
+            old_data = f.read()
+    except IOError:
+        old_data = None
+    if keep > 0 and old_data and old_data != new_data:
+        try:
+            name = json.loads(old_data.decode("utf-8")).get("Sequence")
+        except ValueError:
+            name = None
+        if not name or not re.match(r"^[\w.+-]+$", name):
+            name = hashlib.sha256(old_data).hexdigest()
+        path = os.path.join(history, name)
+        try:
+            os.makedirs(history)
+        except OSError:
+            pass
+        if debug or verbose:
+            print("Keeping previous manifest as %s" % path, file=sync_log)
+        with open(path + ".tmp", "wb") as f:
+            f.write(old_data)
+        os.rename(path + ".tmp", path)
+    kept = RetainedManifests(train_dir, keep)
+    try:
+        names = os.listdir(history)
+    except OSError:
+        names = []
+    archive = os.path.dirname(train_dir)
+    for name in names:
+        path = os.path.join(history, name)
+        if path in kept:
+            continue
+        manifest = LoadManifest(path)
+        retval.extend(os.path.join(archive, file) for file in IterateManifestComponents(manifest, deep=True))
+        if debug or verbose:
+            print("Dropping old manifest %s" % path, file=sync_log)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return retval
+
+def ReferencedFiles(destination, projects, keep=None):
+    """
+    Return the set of files (as full paths) that the saved LATEST of
+    any train listed in each project's trains.txt refers to, along
+    with those the newest keep manifests in its History refer to
+    (see RetainedManifests()).  A manifest the index doesn't know
+    about is assumed to be deep, so that nothing it may need is lost.
+    If fleet_versions is set, the deltas it wants are included as well.
+    """
+    wanted = fleet_versions.Wants if fleet_versions else None
+    retval = set()
+    for project in projects:
+        archive = os.path.join(destination, project)
+        try:
+            with open(os.path.join(archive, "trains.txt"), "r") as f:
+                trains = GetTrains(f.read())
+        except:
+            continue
+        retval.add(os.path.join(archive, "trains.txt"))
+        for t in trains:
+            latest_path = os.path.join(archive, t, "LATEST")
+            manifests = [PreviousManifest(latest_path)]
+            if manifests[0][0] is None and os.path.exists(latest_path):
+                manifests = [(LoadManifest(latest_path), True)]
+            for path in RetainedManifests(os.path.join(archive, t), keep):
+                manifests.append((LoadManifest(path), True))
+                retval.add(path)
+            for (manifest, deep) in manifests:
+                for file in IterateManifestComponents(manifest, deep=deep, wanted=wanted):
+                    retval.add(os.path.join(archive, file))
+            retval.add(latest_path)
+            retval.add(os.path.join(archive, t, "ChangeLog.txt"))
+    return retval
+
+def CollectGarbage(destination, keep=None, keep_files=(), batch_size=1000):
+    """
+    Remove everything in destination that no current manifest needs.
+    Every file reachable from the trains.txt, LATEST, and retained
+    manifests (see ReferencedFiles()) of every project in destination,
+    plus keep_files, is marked; everything else in the project trees
+    is then swept, batch_size files at a time, along with any blob in
+    the store that no longer has any other links, and directories
+    left empty.  A directory without a trains.txt isn't a project
+    we know about, so it is left alone.
+    Returns a tuple of (files removed, bytes reclaimed).
+    """
+    projects = []
+    for name in sorted(os.listdir(destination)):
+        if not name.startswith(".") and os.path.isfile(os.path.join(destination, name, "trains.txt")):
+            projects.append(name)
+    marked = ReferencedFiles(destination, projects, keep)
+    marked.update(keep_files)
+    totals = { "Files" : 0, "Bytes" : 0 }
+
+    def Sweep(batch):
+        for path in batch:
+            try:
+                st = os.lstat(path)
+                os.remove(path)
+            except OSError as e:
+                if debug or verbose:
+                    print("Could not remove %s: %s" % (path, str(e)), file=sync_log)
+                continue
+            totals["Files"] += 1
+            # A file with other links doesn't free anything yet
+            if st.st_nlink == 1:
+                totals["Bytes"] += st.st_size
+            if file_index:
+                file_index.Forget(path)
+        if batch and (debug or verbose):
+            print("Garbage collection: %d files, %d bytes so far" % (totals["Files"], totals["Bytes"]),
+                  file=sync_log)
+        del batch[:]
+
+    batch = []
+    for project in projects:
+        for (dirpath, dirnames, filenames) in os.walk(os.path.join(destination, project)):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if path not in marked:
+                    if debug:
+                        print("Would remove %s" % path, file=sync_log)
+                        continue
+                    batch.append(path)
+                    if len(batch) >= batch_size:
+                        Sweep(batch)
+    Sweep(batch)
+
+    # The project trees are done, so any blob with only one link left is unused.
+    blobs = os.path.join(destination, ".blobs")
+    for (dirpath, dirnames, filenames) in os.walk(blobs):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
             try:
-                curset.pop(os.path.join(destination, t, "LATEST"))
+                if os.lstat(path).st_nlink > 1:
+                    continue
+            except OSError:
+                continue
+            if debug:
+                print("Would remove %s" % path, file=sync_log)
+                continue
+            batch.append(path)
+            if len(batch) >= batch_size:
+                Sweep(batch)
+    Sweep(batch)
+
+    if not debug:
+        for top in [os.path.join(destination, project) for project in projects] + [blobs]:
+            for (dirpath, dirnames, filenames) in os.walk(top, topdown=False):
+                if dirpath != top:
+                    try:
+                        os.rmdir(dirpath)
+                    except OSError:
+                        pass
+    return (totals["Files"], totals["Bytes"])
+
+def PlanProject(project, destination, train=None, deep=False, wanted=None):
+    """
+    Work out what is needed to sync project into destination.
+    If train is set, then only plan for that train
+    Only the differences between the LATEST we synced last time,
+    and the new one, are planned for.
+    If wanted is given (and deep isn't set), the deltas it wants
+    (see IterateManifestComponents()) that we don't have yet are
+    planned for too, for every train, changed or not, since what
+    is wanted changes as clients are updated.
+    Returns a SyncPlan.
+    """
+    plan = SyncPlan(project, destination, deep)
+    trains_path = os.path.join(destination, "trains.txt")
+    old_trains = []
+    if train is None:
+        try:
+            with open(trains_path, "r") as f:
+                old_trains = GetTrains(f.read())
+        except:
+            pass
+        (train_data, validators, changed) = GetMetadataFile(os.path.join(project, "trains.txt"),
+                                                            trains_path)
+        if changed:
+            # trains.txt is small, and may change, so we over-write it
+            # whenever the server says it has changed.
+            plan.metadata.append((trains_path, train_data, validators, {}))
+        trains = GetTrains(train_data)
+    else:
+        trains = train
+    plan.trains = trains
+
+    # The new manifests, and the files that may no longer be needed
+    manifests = {}
+    candidates = set()
+    queued = set()
+    # All of the LATEST files are asked for at once
+    latests = RunConcurrently(lambda t: GetLatest(project, t, os.path.join(destination, t, "LATEST"), deep=deep),
+                              trains)
+    for (t, (manifest_data, validators, changed)) in zip(trains, latests):
+        latest_path = os.path.join(destination, t, "LATEST")
+        if not manifest_data:
+            print("Could not get sane manifest for %s/%s" % (project, t), file=sync_log)
+            continue
+        if not changed:
+            # The last sync of this train finished, at the same depth,
+            # and nothing has changed upstream since, so there is
+            # nothing to do.
+            if debug or verbose:
+                print("%s/%s is up to date" % (project, t), file=sync_log)
+            continue
+        try:
+            manifest = json.loads(manifest_data)
+        except BaseException as e:
+            print("Could not load JSON from manifest %s/%s/LATEST: %s" % (project, t, str(e)), file=sync_log)
+            continue
+        manifests[t] = (manifest, deep)
+        # The manifest is saved as os.path.join(destination, t, "LATEST")
+        # once all of the downloads have finished.
+        plan.metadata.append((latest_path, manifest_data, validators, { "Deep" : deep }))
+        plan.changelogs.append(t)
+        plan.sizes.update(ManifestFileSizes(manifest, deep=deep))
+        for (file, checksum) in IterateManifestComponents(manifest, deep=deep, checksums=True):
+            if checksum:
+                plan.checksums[file] = checksum
+        priorities = ManifestPriorities(manifest, deep=deep)
+        for (file, priority) in priorities.items():
+            plan.priorities[file] = min(priority, plan.priorities.get(file, priority))
+        plan.required[t] = sorted([file for (file, priority) in priorities.items()
+                                   if priority < PRIORITY_DELTA])
+
+        (old_manifest, old_deep) = PreviousManifest(latest_path)
+        (added, removed, modified) = DiffManifests(old_manifest, manifest, old_deep, deep)
+        if debug or verbose:
+            print("%s/%s: %d added, %d removed, %d changed" % (project, t, len(added), len(removed), len(modified)),
+                  file=sync_log)
+        candidates.update(removed)
+
+        for file in added + modified:
+            if file in queued:
+                continue
+            local = os.path.join(destination, file)
+            resumable = False
+            if file.startswith("Packages/"):
+                resumable = True
+            refetch = resumable and file in modified
+            if resumable and not refetch and file_index and file_index.IsComplete(local):
+                if debug:
+                    print("Not downloading %s because the index says it is complete" % file, file=sync_log)
+                continue
+            elif os.path.exists(local) and not resumable and not file_index:
+                if debug or verbose:
+                    print("Not downloading %s because it already exists" % file, file=sync_log)
+                continue
+            queued.add(file)
+            # Notes and validators may be replaced upstream under
+            # the same name, so ask the server if they have changed.
+            plan.downloads.append((file, resumable, not resumable, refetch))
+
+    if wanted and not deep:
+        for t in trains:
+            if t in manifests:
+                manifest = manifests[t][0]
+            else:
+                manifest = PreviousManifest(os.path.join(destination, t, "LATEST"))[0]
+            deltas = (set(IterateManifestComponents(manifest, wanted=wanted)) -
+                      set(IterateManifestComponents(manifest)))
+            if not deltas:
+                continue
+            sizes = ManifestFileSizes(manifest, deep=True)
+            priorities = ManifestPriorities(manifest, deep=True)
+            checksums = dict(IterateManifestComponents(manifest, deep=True, checksums=True))
+            for file in sorted(deltas, key=lambda f: priorities.get(f)):
+                local = os.path.join(destination, file)
+                if file in queued:
+                    continue
+                if file_index and file_index.IsComplete(local):
+                    continue
+                if not file_index and os.path.exists(local):
+                    continue
+                queued.add(file)
+                plan.downloads.append((file, True, False, False))
+                plan.priorities[file] = priorities[file]
+                if file in sizes:
+                    plan.sizes[file] = sizes[file]
+                if checksums.get(file):
+                    plan.checksums[file] = checksums[file]
+            if debug or verbose:
+                print("%s/%s: %d deltas wanted by clients" % (project, t, len(deltas)), file=sync_log)
+
+    # Trains that have been dropped from trains.txt
+    for t in old_trains:
+        if t not in trains:
+            (old_manifest, old_deep) = PreviousManifest(os.path.join(destination, t, "LATEST"))
+            candidates.update(IterateManifestComponents(old_manifest, deep=old_deep))
+            candidates.update([os.path.join(t, "LATEST"), os.path.join(t, "ChangeLog.txt")])
+
+    if candidates:
+        # A file dropped by one train may still be used by another one;
+        # if only some trains are being synced, that includes the others.
+        all_trains = set(trains)
+        if train is not None:
+            try:
+                with open(trains_path, "r") as f:
+                    all_trains |= set(GetTrains(f.read()))
             except:
                 pass
+        for t in all_trains:
+            if t in manifests:
+                (manifest, manifest_deep) = manifests[t]
+            else:
+                (manifest, manifest_deep) = PreviousManifest(os.path.join(destination, t, "LATEST"))
+            for file in IterateManifestComponents(manifest, deep=manifest_deep):
+                candidates.discard(file)
+        plan.stale = sorted(candidates)
+    return plan
+
+class PlanExecution(object):
+    """
+    Carries out a SyncPlan:  Start() queues everything it lists on
+    pool, and once the pool has been waited for, Finish() saves the
+    remaining metadata, and returns the list of files (as full paths)
+    that are no longer needed.  Several plans can be in progress on
+    the same pool at once.
+    Each train's LATEST is saved as soon as the files it requires are
+    present, without waiting for the deltas (it is recorded as not
+    deep until they have all arrived), and trains.txt once every
+    train's LATEST has been saved; so a long deep sync can serve a new
+    release early.  If that fails, error is set, and Finish() raises it.
+    """
+    def __init__(self, plan, pool):
+        self.plan = plan
+        self.pool = pool
+        # The metadata is published in pieces, as the downloads finish.
+        self._latest = {}
+        self._trains_txt = []
+        for entry in plan.metadata:
+            if entry[0].endswith("trains.txt"):
+                self._trains_txt.append(entry)
+            else:
+                self._latest[os.path.relpath(os.path.dirname(entry[0]), plan.destination)] = entry
+        downloading = set([download[0] for download in plan.downloads])
+        self._waiting = {}
+        for t in self._latest:
+            self._waiting[t] = set(plan.required.get(t, downloading)) & downloading
+        self._outstanding = set([os.path.join(plan.destination, file) for file in downloading])
+        self._published = {}
+        self._dropped = []
+        self._lock = threading.Lock()
+        self.error = None
+
+    def _Publish(self, t=None):
+        # Called with _lock held
+        if t is not None:
+            (local, data, validators, extra) = self._latest[t]
+            if debug:
+                return
+            if self.plan.deep:
+                # Not until the deltas are here too
+                extra = dict(extra, Deep=False)
+            self._dropped.extend(RetainManifest(local, data))
+            SaveMetadataFile(local, data, validators, **extra)
+            self._published[t] = extra
+            if len(self._published) < len(self._latest):
+                return
+        for (local, data, validators, extra) in self._trains_txt:
+            SaveMetadataFile(local, data, validators, **extra)
+        del self._trains_txt[:]
+
+    def _PublishEarly(self, t):
+        # Called with _lock held, often on a download thread, so a
+        # failure is kept for Finish() rather than raised here.
+        try:
+            self._Publish(t)
+        except Exception as e:
+            print("Could not save %s/%s/LATEST: %s" % (self.plan.project, t, str(e)), file=sync_log)
+            if self.error is None:
+                self.error = e
+
+    def _Arrived(self, out):
+        file = os.path.relpath(out, self.plan.destination)
+        with self._lock:
+            self._outstanding.discard(out)
+            for t in list(self._waiting):
+                if file in self._waiting[t]:
+                    self._waiting[t].discard(file)
+                    if not self._waiting[t]:
+                        del self._waiting[t]
+                        if t not in self._published:
+                            self._PublishEarly(t)
+
+    def Start(self):
+        plan = self.plan
+        destination = plan.destination
+        made_dirs = set()
+        # Whatever the manifests list that isn't being downloaded, we have
+        downloading = set([download[0] for download in plan.downloads])
+        for (file, size) in plan.sizes.items():
+            if file not in downloading:
+                CountMetric("FilesSkipped")
+                CountMetric("BytesSkipped", size or 0)
+        for (file, resumable, conditional, refetch) in sorted(plan.downloads,
+                                                              key=lambda d: plan.priorities.get(d[0], PRIORITY_METADATA)):
+            local = os.path.join(destination, file)
+            if refetch and not debug:
+                # Same name, different contents, so it can't be resumed
+                if file_index:
+                    file_index.Forget(local)
+                try:
+                    os.remove(local)
+                except:
+                    pass
+            dirname = os.path.dirname(local)
+            if dirname not in made_dirs:
+                made_dirs.add(dirname)
+                try:
+                    os.makedirs(dirname)
+                except BaseException as e:
+                    if debug:
+                        print("Did not mkdir %s: %s" % (dirname, str(e)), file=sync_log)
+            if debug:
+                print("Downloading SERVER/%s -> %s" % (os.path.join(plan.project, file), local),
+                      file=sync_log)
+            elif not self.pool.Add(os.path.join(plan.project, file),
+                                   local,
+                                   priority = plan.priorities.get(file, PRIORITY_METADATA),
+                                   done = self._Arrived,
+                                   resume = resumable,
+                                   conditional = conditional,
+                                   size = plan.sizes.get(file),
+                                   checksum = plan.checksums.get(file)
+                                   ):
+                # Already downloaded during this run
+                self._Arrived(local)
+
+        # Trains that don't need any of the downloads
+        with self._lock:
+            for t in sorted(self._latest):
+                if not self._waiting.get(t) and t not in self._published:
+                    self._waiting.pop(t, None)
+                    self._PublishEarly(t)
+
+        for t in plan.changelogs:
+            if debug:
+                continue
             try:
-                GetNetworkFile(os.path.join(project, t, "ChangeLog.txt"),
-                               os.path.join(destination, t, "ChangeLog.txt"))
+                os.makedirs(os.path.join(destination, t))
             except:
                 pass
-            
+            # Nice to have, so a failure doesn't stop the train
+            self.pool.Add(os.path.join(plan.project, t, "ChangeLog.txt"),
+                          os.path.join(destination, t, "ChangeLog.txt"),
+                          priority = PRIORITY_METADATA,
+                          optional = True,
+                          conditional = True)
+
+    def Finish(self):
+        """
+        Call once the pool has finished everything Start() queued.
+        Raises DownloadFailed if some of this plan's files couldn't
+        be downloaded; the LATEST files that could be saved early
+        stay, but nothing else is saved.  Likewise if one of them
+        couldn't be saved early, that error is raised.
+        """
+        with self._lock:
+            if self.error is not None and not debug:
+                raise self.error
+            if self._outstanding and not debug:
+                raise DownloadFailed([failure for failure in self.pool.failures
+                                      if failure[1] in self._outstanding])
+            for t in sorted(self._latest):
+                (local, data, validators, extra) = self._latest[t]
+                if debug:
+                    continue
+                if self._published.get(t) != extra:
+                    # Now it has the deltas, too
+                    SaveMetadataFile(local, data, validators, **extra)
+            self._Publish()
+        return [os.path.join(self.plan.destination, file) for file in self.plan.stale] + self._dropped
+
+def DiscoverProjects(projects, destination, train=None, deep=False, wanted=None):
+    """
+    Plan all of projects at once (see PlanProject()); the plan for
+    project is for os.path.join(destination, project).  Yields a
+    (project, plan, error) tuple for each project as soon as its
+    planning is done, so its downloads can start while the others
+    are still being planned.  If planning failed, plan is None, and
+    error is the exception.
+    """
+    results = queue.Queue()
+    def Discover(project):
+        try:
+            results.put((project, PlanProject(project, os.path.join(destination, project), train,
+                                              deep=deep, wanted=wanted), None))
+        except BaseException as e:
+            results.put((project, None, e))
+    for project in projects:
+        thread = threading.Thread(target=Discover, args=(project,))
+        thread.daemon = True
+        thread.start()
+    for project in projects:
+        yield results.get()
+
+def ExecutePlan(plan, pool=None):
+    """
+    Carry out a SyncPlan (see PlanExecution), using pool; if that
+    is None, a pool of max_jobs workers is used just for this.
+    Returns the list of files (as full paths) that are no longer needed.
+    """
+    if pool is None:
+        project_pool = NewDownloadPool(max_jobs)
+    else:
+        project_pool = pool
+    execution = PlanExecution(plan, project_pool)
+    try:
+        execution.Start()
+        try:
+            project_pool.Wait()
+        except DownloadFailed:
+            # Possibly some other plan's; Finish() sorts out whose
+            pass
+    finally:
+        if pool is None:
+            project_pool.Close()
+    return execution.Finish()
+
+def ReportPlan(plans, destination, output=None):
+    """
+    Write out the given SyncPlans as JSON:  for each project, the files
+    to fetch (with their sizes, from the manifest or a HEAD request),
+    the files to resume, the files that will be linked from the blob
+    store, and the files to delete; then the totals,
+    the free space in destination, and an estimate of how long the
+    sync would take, at the throughput the last sync got (or, failing
+    that, what fetching the manifests got).
+    """
+    if output is None:
+        output = sys.stdout
+    report = { "Projects" : [] }
+    total_bytes = 0
+    total_requests = 0
+    # Blobs that will be downloaded, by any of the plans
+    blobs = set()
+    for plan in plans:
+        fetch = []
+        resume = []
+        link = []
+        delete = []
+        for (file, resumable, conditional, refetch) in plan.downloads:
+            local = os.path.join(plan.destination, file)
+            sha = plan.checksums.get(file, "").lower()
+            if blob_store and len(sha) == 64 and not conditional:
+                if sha in blobs or blob_store.Has(sha):
+                    link.append({ "Path" : local, "SHA256" : sha })
+                    continue
+                blobs.add(sha)
+            size = plan.sizes.get(file)
+            if size is None:
+                size = RemoteFileSize(os.path.join(plan.project, file))
+            have = 0
+            if resumable and not refetch:
+                try:
+                    have = os.path.getsize(local)
+                except OSError:
+                    have = 0
+            if have:
+                resume.append({ "Path" : local, "Size" : size, "Have" : have })
+                if size is not None:
+                    total_bytes += max(0, size - have)
+            else:
+                fetch.append({ "Path" : local, "Size" : size, "Conditional" : conditional })
+                if size is not None and not (conditional and os.path.exists(local)):
+                    total_bytes += size
+        for file in plan.stale:
+            local = os.path.join(plan.destination, file)
+            try:
+                size = os.path.getsize(local)
+            except OSError:
+                continue
+            delete.append({ "Path" : local, "Size" : size })
+        total_requests += len(plan.downloads) - len(link) + len(plan.changelogs)
+        report["Projects"].append({
+            "Project" : plan.project,
+            "Trains" : plan.trains,
+            "Deep" : plan.deep,
+            "Fetch" : fetch,
+            "Resume" : resume,
+            "Link" : link,
+            "Delete" : delete,
+            "DeleteBytes" : sum(x["Size"] for x in delete),
+        })
+
+    throughput = LoadSyncStats(destination).get("Throughput")
+    if not throughput and transfer_totals["Seconds"] > 0:
+        throughput = transfer_totals["Bytes"] / transfer_totals["Seconds"]
+    report["Requests"] = total_requests
+    report["Bytes"] = total_bytes
+    report["Throughput"] = throughput
+    report["EstimatedSeconds"] = int(total_bytes / throughput) if throughput else None
+    try:
+        existing = os.path.abspath(destination)
+        while not os.path.exists(existing):
+            existing = os.path.dirname(existing)
+        st = os.statvfs(existing)
+        report["FreeBytes"] = st.f_bavail * st.f_frsize
+    except (OSError, AttributeError):
+        report["FreeBytes"] = None
+    json.dump(report, output, sort_keys=True, indent=4, separators=(',', ': '))
+    output.write("\n")
+
 def LoadManifest(path):
     import json
 
@@ -278,59 +3642,853 @@ def LoadManifest(path):
         with open(path) as f:
             retval = json.load(f)
     except BaseException as e:
-        print("Could not load manifest from %s: %s" % (path, str(e)), file=sys.stderr)
+        print("Could not load manifest from %s: %s" % (path, str(e)), file=sync_log)
         return None
     return retval
 
-def FindExistingFiles(archive, train=None, deep=False):
+class PullThroughFetch(object):
     """
-    Find all of the files in the archive and train.
-    If train is None, then it will look for trains.txt and use that
-    to list the trains.  Note that trains.txt will be included in the file.
-    Files are relative to archive.
+    One upstream fetch for the pull-through server (see PullThrough).
+    The file is written to tmp (already open as fd, and this fetch's
+    alone) as it arrives; any number of clients
+    can Attach() to it and stream it from there while it is still
+    being written.  If it is to be cached, it is linked into place
+    at local once it is complete.
     """
-    retval = { }
-    if train is None:
-        print("archive = %s" % archive)
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path, local, fd, tmp):
+        self.path = path
+        self.local = local
+        self.tmp = tmp
+        self.status = None
+        self.length = None
+        self.done = False
+        self.failed = False
+        self.cond = threading.Condition()
+        self._clients = 0
+        self._out = os.fdopen(fd, "wb")
+
+    def Run(self, finished):
+        headers = { "User-Agent" : "ix-server-sync=%s" % Version }
+        ok = False
         try:
-            train_data = open(os.path.join(archive, "trains.txt")).read()
-            trains = GetTrains(train_data)
+            try:
+                (response, slot, base_url) = OpenFromMirrors(self.path, headers)
+            except HTTPError as e:
+                with self.cond:
+                    self.status = e.code
+                return
+            started = time.time()
+            received = 0
+            try:
+                length = response.getheader("Content-Length")
+                with self.cond:
+                    self.status = httplib.OK
+                    self.length = int(length) if length is not None else None
+                    self.cond.notify_all()
+                while True:
+                    data = response.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    self._out.write(data)
+                    self._out.flush()
+                    received += len(data)
+                    with self.cond:
+                        self.cond.notify_all()
+                    Throttle(len(data))
+                if self.length is not None and received != self.length:
+                    raise IOError("Short read for %s: got %d of %d bytes" % (self.path, received, self.length))
+                ok = True
+            finally:
+                response.close()
+                slot.release()
+                CountTransfer(received, time.time() - started)
+                GetMirrors().RecordThroughput(base_url, received, time.time() - started)
         except BaseException as e:
-            # No trains.txt, so no files to look at
-            if debug or verbose:
-                print("Could not open trains.txt: %s" % str(e), file=sys.stderr)
-            return {}
+            print("Could not fetch %s: %s" % (self.path, str(e)), file=sync_log)
+            with self.cond:
+                if self.status is None:
+                    self.status = httplib.BAD_GATEWAY
+        finally:
+            self._out.close()
+            if ok and self.local:
+                try:
+                    os.makedirs(os.path.dirname(self.local))
+                except OSError:
+                    pass
+                try:
+                    os.link(self.tmp, self.local)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        print("Could not cache %s: %s" % (self.local, str(e)), file=sync_log)
+            finished(self)
+            with self.cond:
+                self.done = True
+                self.failed = not ok
+                self.cond.notify_all()
+                if self._clients == 0:
+                    self._Remove()
+
+    def _Remove(self):
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+    def Attach(self):
+        """
+        Return a file object to read the download from.
+        Must be called before the fetch is finished.
+        """
+        with self.cond:
+            self._clients += 1
+            return open(self.tmp, "rb")
+
+    def Detach(self, reader):
+        reader.close()
+        with self.cond:
+            self._clients -= 1
+            if self.done and self._clients == 0:
+                self._Remove()
+
+    def WaitForStatus(self):
+        with self.cond:
+            while self.status is None:
+                self.cond.wait(1.0)
+            return (self.status, self.length)
+
+    def Stream(self, reader, output):
+        """
+        Copy the download to output, as it arrives.
+        Returns False if the upstream fetch failed part way through.
+        """
+        while True:
+            data = reader.read(self.CHUNK_SIZE)
+            if data:
+                output.write(data)
+                continue
+            with self.cond:
+                if not self.done:
+                    self.cond.wait(1.0)
+                    continue
+            # Finished; whatever was written is there to be read
+            while True:
+                data = reader.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                output.write(data)
+            return not self.failed
+
+class PullThrough(object):
+    """
+    The pull-through cache:  a miss in destination is fetched from the
+    mirrors (see OpenFromMirrors()) and streamed to the client, while
+    packages are also written into destination, so the next request is
+    served from disk.  Concurrent requests for the same path share one
+    upstream fetch.  Metadata (trains.txt, LATEST and so on) changes
+    upstream, so it is passed through without being cached; the sync
+    takes care of it.
+    """
+    CACHEABLE = re.compile(r"^[^/]+/Packages/[^/]+\.tgz$")
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.spool = os.path.join(destination, ".pull")
+        self._lock = threading.Lock()
+        self._fetches = {}
+        try:
+            os.makedirs(self.spool)
+        except OSError:
+            pass
+
+    def LocalPath(self, path):
+        """
+        Return the file in destination for the request path, or
+        None if it isn't a file we would have.
+        """
+        path = path.split("?", 1)[0].lstrip("/")
+        parts = path.split("/")
+        if not path or any(part in ("", ".", "..") or part.startswith(".") for part in parts):
+            return None
+        return os.path.join(self.destination, *parts)
+
+    def _Finished(self, fetch):
+        with self._lock:
+            if self._fetches.get(fetch.path) is fetch:
+                del self._fetches[fetch.path]
+
+    def Fetch(self, path):
+        """
+        Return a tuple of (fetch, reader) for path, starting an upstream
+        fetch if there isn't already one; see PullThroughFetch.
+        """
+        with self._lock:
+            fetch = self._fetches.get(path)
+            if fetch is None:
+                local = None
+                if self.CACHEABLE.match(path):
+                    local = os.path.join(self.destination, path)
+                # Clients of an earlier fetch of path may still be
+                # reading its file, so each fetch gets a new one.
+                (fd, tmp) = tempfile.mkstemp(dir=self.spool)
+                # It may be linked into place, for nginx to serve
+                os.chmod(tmp, 0o644)
+                fetch = PullThroughFetch(path, local, fd, tmp)
+                self._fetches[path] = fetch
+                worker = threading.Thread(target=fetch.Run, args=(self._Finished,))
+                worker.daemon = True
+                worker.start()
+            return (fetch, fetch.Attach())
+
+def ServePullThrough(destination, address):
+    """
+    Run the pull-through cache (see PullThrough) for destination,
+    listening on address ("[host:]port"; the host defaults to
+    127.0.0.1), until interrupted.  nginx should fall back to it
+    for files it doesn't have, e.g.:
+    	location / { try_files $uri @pull; }
+    	location @pull { proxy_pass http://127.0.0.1:8081; proxy_buffering off; }
+    """
+    if sys.version_info[0] < 3:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
     else:
-        trains = [train]
-
-    for t in trains:
-        # We only care about LATEST in each train
-        man_path = os.path.join(archive, t, "LATEST")
-        manifest = LoadManifest(man_path)
-        if manifest:
-            for file in IterateManifestComponents(manifest, deep=deep):
-                if debug:
-                    print("Found existing file %s" % os.path.join(archive, file), file=sys.stderr)
-                retval[os.path.join(archive, file)] = True
-        else:
-            print("Hm, %s was not a manifest?" % man_path, file=sys.stderr)
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
 
-    return retval
+    (host, sep, port) = address.rpartition(":")
+    cache = PullThrough(destination)
+
+    class Handler(BaseHTTPRequestHandler):
+        server_version = "ix-server-sync/%s" % Version
+
+        def log_message(self, format, *args):
+            if debug or verbose:
+                print("%s %s" % (self.address_string(), format % args), file=sync_log)
+
+        def _SendFile(self, local, body):
+            with open(local, "rb") as f:
+                self.send_response(httplib.OK)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+                self.end_headers()
+                if body:
+                    while True:
+                        data = f.read(PullThroughFetch.CHUNK_SIZE)
+                        if not data:
+                            break
+                        self.wfile.write(data)
+
+        def do_HEAD(self):
+            local = cache.LocalPath(self.path)
+            if local is None:
+                self.send_error(httplib.NOT_FOUND)
+            elif os.path.isfile(local):
+                self._SendFile(local, False)
+            else:
+                path = os.path.relpath(local, destination)
+                try:
+                    (response, slot, base_url) = OpenFromMirrors(path, {}, method="HEAD")
+                except HTTPError as e:
+                    self.send_error(e.code)
+                    return
+                except BaseException:
+                    self.send_error(httplib.BAD_GATEWAY)
+                    return
+                try:
+                    self.send_response(httplib.OK)
+                    for header in ("Content-Length", "Last-Modified", "ETag"):
+                        if response.getheader(header):
+                            self.send_header(header, response.getheader(header))
+                    self.end_headers()
+                finally:
+                    response.close()
+                    slot.release()
+
+        def do_GET(self):
+            local = cache.LocalPath(self.path)
+            if local is None:
+                self.send_error(httplib.NOT_FOUND)
+                return
+            if os.path.isfile(local):
+                self._SendFile(local, True)
+                return
+            (fetch, reader) = cache.Fetch(os.path.relpath(local, destination))
+            try:
+                (status, length) = fetch.WaitForStatus()
+                if status != httplib.OK:
+                    self.send_error(status)
+                    return
+                self.send_response(httplib.OK)
+                self.send_header("Content-Type", "application/octet-stream")
+                if length is not None:
+                    self.send_header("Content-Length", str(length))
+                self.end_headers()
+                if not fetch.Stream(reader, self.wfile):
+                    # Too late for an error; the short read will do
+                    self.close_connection = True
+            except socket.error:
+                # The client went away; the fetch carries on regardless
+                pass
+            finally:
+                fetch.Detach(reader)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = Server((host or "127.0.0.1", int(port)), Handler)
+    if debug or verbose:
+        print("Serving cache misses for %s on %s:%s" % (destination, host or "127.0.0.1", port), file=sync_log)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+class SyncLock(object):
+    """
+    Makes sure only one sync at a time writes into a destination,
+    whoever started it (cron, custard's menu, or by hand), with an
+    flock() on <destination>/.sync-lock, which also holds the pid of
+    the sync that has it.  A sync that finds it taken leaves
+    <destination>/.sync-queued instead, asking the holder to sync once
+    more when it is done; however many ask, that is one more run.
+    The holder checks for that after letting go of the lock, so that
+    a request made just as it finished is not lost.
+    """
+    def __init__(self, destination):
+        self.path = os.path.join(destination, ".sync-lock")
+        self.queued_path = os.path.join(destination, ".sync-queued")
+        self._file = open(self.path, "a+")
+        self.held = False
+
+    def Acquire(self, wait=False):
+        """
+        Take the lock, waiting for it if wait is set.
+        Returns False if someone else has it.
+        """
+        flags = fcntl.LOCK_EX
+        if not wait:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._file.fileno(), flags)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return False
+            raise
+        self.held = True
+        self._file.truncate(0)
+        self._file.write("%d\n" % os.getpid())
+        self._file.flush()
+        return True
+
+    def Release(self):
+        if self.held:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self.held = False
+
+    def Holder(self):
+        """
+        Return the pid of the sync holding the lock (or
+        that last held it), or None if we can't tell.
+        """
+        try:
+            with open(self.path, "r") as f:
+                return int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def Queue(self):
+        open(self.queued_path, "a").close()
+
+    def Queued(self):
+        return os.path.exists(self.queued_path)
+
+    def TakeQueued(self):
+        """
+        Remove the request for another run, if there is one.
+        Returns True if there was.
+        """
+        try:
+            os.remove(self.queued_path)
+            return True
+        except OSError:
+            return False
+
+    def Close(self):
+        self.Release()
+        self._file.close()
+
+class Syncer(object):
+    """
+    Keeps destination in sync with the update servers.  This is what
+    main() runs, and what other programs (custard, or a daemon that
+    syncs on a schedule) can use instead of running us:
+
+        syncer = Syncer("/usr/local/www/nginx", urls=[...], deep=True)
+        if not syncer.Sync():
+            print(syncer.failures)
+
+    The keyword arguments are the command line options; rate_limit is
+    a schedule, as for --rate-limit (ValueError if it isn't valid), and
+    retries is the number of retries for each file.  If log (a file
+    object) is given, the messages go there instead of sys.stderr.
+    callback, if given, is called as callback(event, info), from the
+    sync's own threads, so it should be quick:
+    phase	-- the run has moved on; info["Phase"] is the new phase
+    file	-- a download is done; info has Path, Output and Failed
+    progress	-- every SyncProgress.INTERVAL seconds; info is what
+    		   goes in .sync-progress
+    finished	-- the run is over; info is what goes in .sync-summary
+    Cancel() (from any thread) stops a Sync() as soon as it can.  What
+    it has done is kept, as for an interrupted run, and the next Sync()
+    carries on from there.
+    A Syncer keeps its connections, what it knows about the mirrors, the
+    index and the blob store from one run to the next, so a long-running
+    program should keep using the one Syncer, and Close() it at the end.
+    Only one Syncer runs at a time (see syncer_lock), and only one sync
+    into a destination, in any process (see SyncLock).
+    """
+    def __init__(self, destination, urls=None, projects=None, trains=None, deep=False,
+                 jobs=max_jobs, mirror_jobs=max_mirror_jobs, engine=download_engine,
+                 segments=max_segments, segment_threshold=segment_threshold,
+                 rate_limit=None, retries=max_attempts - 1, dedupe=True, gc=False,
+                 keep_releases=keep_releases, fleet_logs=(), fleet_versions=(),
+                 metrics_file=None, verbose=False, debug=False, callback=None, log=None):
+        if engine not in ("threads", "events"):
+            raise ValueError("Unknown download engine %s" % engine)
+        self.destination = destination
+        self.urls = list(urls or default_urls)
+        self.projects = list(projects or Projects)
+        self.trains = list(trains) if trains else None
+        self.deep = deep
+        self.jobs = max(1, jobs)
+        self.mirror_jobs = mirror_jobs
+        self.engine = engine
+        self.segments = max(1, segments)
+        self.segment_threshold = segment_threshold
+        self.rate_limiter = RateLimiter(ParseSchedule(rate_limit)) if rate_limit else None
+        self.retries = max(0, retries)
+        self.dedupe = dedupe
+        self.gc = gc
+        self.keep_releases = max(0, keep_releases)
+        self.fleet_logs = list(fleet_logs)
+        self.fleet_versions = list(fleet_versions)
+        self.metrics_file = metrics_file
+        self.verbose = verbose
+        self.debug = debug
+        self.callback = callback
+        self.log = log
+        # What the last Sync() did
+        self.summary = None
+        self.failures = []
+        self.cancelled = False
+        # The pid of the other sync that Sync() left a request with
+        self.queued = None
+        self._pool = None
+        self._file_index = None
+        self._blob_store = None
+        self._mirror_manager = None
+
+    def _Configure(self):
+        """
+        Make the globals ours for a run.  Must be called with
+        syncer_lock held.
+        """
+        global debug, verbose, sync_log
+        global url_list, mirror_manager
+        global max_jobs, max_mirror_jobs
+        global max_segments, segment_threshold
+        global rate_limiter, max_attempts
+        global keep_releases, download_engine
+        global file_index, blob_store, fleet_versions
+        global sync_metrics, sync_progress
+        debug = self.debug
+        verbose = self.verbose
+        sync_log = self.log or sys.stderr
+        url_list = self.urls
+        max_jobs = self.jobs
+        max_mirror_jobs = self.mirror_jobs
+        max_segments = self.segments
+        segment_threshold = self.segment_threshold
+        rate_limiter = self.rate_limiter
+        max_attempts = self.retries + 1
+        keep_releases = self.keep_releases
+        download_engine = self.engine
+        with mirror_slots_lock:
+            mirror_slots.clear()
+        if self._mirror_manager is None:
+            self._mirror_manager = MirrorManager(self.urls)
+        self._mirror_manager.NewRun()
+        with mirror_manager_lock:
+            mirror_manager = self._mirror_manager
+        file_index = None
+        blob_store = None
+        fleet_versions = None
+        sync_metrics = None
+        sync_progress = None
+        with transfer_totals_lock:
+            transfer_totals["Bytes"] = 0
+            transfer_totals["Seconds"] = 0.0
+        sync_cancelled.clear()
+        self.cancelled = False
+
+    def _OpenIndex(self):
+        """
+        Set file_index and blob_store for destination, keeping the
+        ones from the last run unless something else has changed the
+        index since.
+        """
+        global file_index, blob_store
+        if self._file_index is None or self._file_index.Changed():
+            self._file_index = FileIndex(os.path.join(self.destination, ".sync-index"))
+        file_index = self._file_index
+        if self.dedupe:
+            if self._blob_store is None:
+                self._blob_store = BlobStore(os.path.join(self.destination, ".blobs"))
+            blob_store = self._blob_store
+
+    def _Wanted(self):
+        """
+        Returns (deep, wanted) for planning:  a deep sync for a known
+        fleet only wants the deltas it can use.
+        """
+        global fleet_versions
+        if not (self.deep and (self.fleet_logs or self.fleet_versions)):
+            return (self.deep, None)
+        fleet_versions = FleetVersions(None if self.debug else os.path.join(self.destination, ".fleet-versions"),
+                                       self.fleet_versions)
+        for log in self.fleet_logs:
+            fleet_versions.Learn(log)
+        return (False, fleet_versions.Wants)
+
+    def CheckForUpdate(self):
+        with syncer_lock:
+            self._Configure()
+            CheckForUpdate()
+
+    def Serve(self, address):
+        """
+        Serve cache misses for destination on address
+        ([host:]port) until interrupted; see ServePullThrough().
+        """
+        with syncer_lock:
+            self._Configure()
+            GetMirrors().Probe(os.path.join(self.projects[0], "trains.txt"))
+            ServePullThrough(self.destination, address)
+
+    def Plan(self, output=None):
+        """
+        Report what Sync() would do (see ReportPlan()), without
+        changing anything.
+        """
+        with syncer_lock:
+            self._Configure()
+            GetMirrors().Probe(os.path.join(self.projects[0], "trains.txt"))
+            (deep, wanted) = self._Wanted()
+            # Nothing is written, but the index tells us what we already have
+            self._OpenIndex()
+            plans = {}
+            for (project, plan, error) in DiscoverProjects(self.projects, self.destination, self.trains,
+                                                           deep=deep, wanted=wanted):
+                if error:
+                    raise error
+                plans[project] = plan
+            ReportPlan([plans[project] for project in self.projects], self.destination, output)
+
+    def Cancel(self):
+        """
+        Stop the Sync() in progress as soon as possible.
+        """
+        sync_cancelled.set()
+        pool = self._pool
+        if pool:
+            pool.Cancel()
+
+    def Close(self):
+        """
+        Close the connections kept between runs.
+        """
+        with syncer_lock:
+            CloseConnectionPools()
+            if self._file_index:
+                self._file_index.Close()
+
+    def Sync(self, wait=False):
+        """
+        Bring destination up to date.  Returns True if everything was
+        synced; otherwise, failures is the list of (path, error, attempts)
+        for the files that couldn't be downloaded, and cancelled says
+        whether Cancel() was the reason.
+        If another sync into destination is running, it is asked to run
+        again when it is done (see SyncLock), since it may have planned
+        before whatever we were started for.  Then, if wait is set, we
+        wait for that, and return how it went; otherwise, queued is set
+        to its pid (0 if we don't know it), and True is returned.
+        """
+        global sync_log
+        with syncer_lock:
+            self.queued = None
+            sync_log = self.log or sys.stderr
+            if self.debug:
+                # Nothing is written, so there's nothing to protect
+                return self._Run()
+            try:
+                os.makedirs(self.destination)
+            except OSError:
+                pass
+            lock = SyncLock(self.destination)
+            try:
+                if not lock.Acquire():
+                    lock.Queue()
+                    if not lock.Acquire(wait):
+                        self.queued = lock.Holder() or 0
+                        print("A sync into %s is already running (pid %d); it will sync again when it is done" %
+                              (self.destination, self.queued), file=sync_log)
+                        return True
+                    if not lock.TakeQueued():
+                        # It did our run as well
+                        return LoadSyncSummary(self.destination).get("Success", False)
+                else:
+                    lock.TakeQueued()
+                while True:
+                    retval = self._Run()
+                    lock.Release()
+                    if not lock.Queued() or not lock.Acquire():
+                        return retval
+                    if not lock.TakeQueued():
+                        # Someone else got in first, and has done it
+                        lock.Release()
+                        return retval
+                    if debug or verbose:
+                        print("Syncing again, as asked during the last run", file=sync_log)
+            finally:
+                lock.Close()
+
+    def _Run(self):
+        self._Configure()
+        try:
+            return self._Sync()
+        finally:
+            self._pool = None
+
+    def _Sync(self):
+        global sync_metrics, sync_progress
+        destination = self.destination
+        projects = self.projects
+        GetMirrors().Probe(os.path.join(projects[0], "trains.txt"))
+        (deep, wanted) = self._Wanted()
+
+        if destination and not debug:
+            try:
+                os.makedirs(destination)
+            except:
+                pass
+            self._OpenIndex()
+        if fleet_versions:
+            fleet_versions.Save()
+
+        sync_metrics = SyncMetrics()
+        journal = None
+        stale_files = set()
+        if not debug:
+            journal = SyncJournal(os.path.join(destination, ".sync-journal"))
+            journal.Begin()
+            stale_files.update(journal.stale)
+        if not debug or self.callback:
+            sync_progress = SyncProgress(None if debug else os.path.join(destination, ".sync-progress"),
+                                         self.callback)
+            sync_progress.Start()
+
+        started = time.time()
+        pool = NewDownloadPool(max_jobs, done=journal.RecordDone if journal else None)
+        self._pool = pool
+        finished = False
+        try:
+            if journal:
+                # First finish whatever an interrupted run was doing
+                phase_started = time.time()
+                SetPhase("Resuming")
+                for plan in journal.Unfinished():
+                    if sync_cancelled.is_set():
+                        break
+                    if verbose:
+                        print("Resuming interrupted sync of %s: %d files left" % (plan.project, len(plan.downloads)),
+                              file=sync_log)
+                    try:
+                        ExecutePlan(plan, pool)
+                        journal.RecordSaved(plan.project)
+                    except Exception as e:
+                        # Most likely things have moved on upstream; the new
+                        # plan below will take care of it.
+                        if not sync_cancelled.is_set():
+                            print("Could not finish interrupted sync of %s: %s" % (plan.project, str(e)),
+                                  file=sync_log)
+                sync_metrics.RecordPhase("Resume", phase_started)
+
+            # Each project's downloads start as soon as it has been planned,
+            # while the others are still being planned.
+            executions = []
+            failed_projects = []
+            unsaved_projects = []
+            phase_started = time.time()
+            SetPhase("Planning")
+            for (project, plan, error) in DiscoverProjects(projects, destination, self.trains, deep=deep, wanted=wanted):
+                if error:
+                    if not isinstance(error, SyncCancelled):
+                        print("Could not plan sync of %s: %s" % (project, str(error)), file=sync_log)
+                    failed_projects.append(project)
+                    continue
+                if sync_cancelled.is_set():
+                    failed_projects.append(project)
+                    continue
+                if journal:
+                    journal.RecordPlan(plan)
+                execution = PlanExecution(plan, pool)
+                execution.Start()
+                executions.append(execution)
+            sync_metrics.RecordPhase("Discovery", phase_started)
+            SetPhase("Downloading")
+            try:
+                pool.Wait()
+            except DownloadFailed:
+                pass
+            # This overlaps discovery, since downloads start as soon as they can
+            sync_metrics.RecordPhase("Download", phase_started)
+            phase_started = time.time()
+            SetPhase("Saving manifests")
+            for execution in executions:
+                project = execution.plan.project
+                try:
+                    stale_files.update(execution.Finish())
+                except DownloadFailed:
+                    # The old LATEST stays in place, and the journal keeps
+                    # the plan, so the next run tries again.
+                    if not sync_cancelled.is_set():
+                        print("Could not finish %s: some files could not be downloaded" % project, file=sync_log)
+                    continue
+                except EnvironmentError as e:
+                    print("Could not finish %s: %s" % (project, str(e)), file=sync_log)
+                    unsaved_projects.append(project)
+                    continue
+                if journal:
+                    journal.RecordSaved(project)
+            sync_metrics.RecordPhase("Finish", phase_started)
+
+            self.cancelled = sync_cancelled.is_set()
+            failed = {}
+            for (path, out, error, attempts) in pool.failures:
+                failed[out] = (path, error, attempts)
+            self.failures = [failed[out] for out in sorted(failed)]
+            if self.cancelled:
+                print("Sync cancelled; the next one will carry on from here", file=sync_log)
+            elif failed or failed_projects or unsaved_projects:
+                if failed_projects:
+                    print("Could not plan sync of: %s" % " ".join(failed_projects), file=sync_log)
+                if unsaved_projects:
+                    print("Could not save the manifests of: %s" % " ".join(unsaved_projects), file=sync_log)
+                if failed:
+                    print("%d file(s) could not be downloaded:" % len(failed), file=sync_log)
+                for (path, error, attempts) in self.failures:
+                    print("\t%s: %s (%d attempt%s)" % (path, str(error), attempts, "" if attempts == 1 else "s"),
+                          file=sync_log)
+            success = not (failed or failed_projects or unsaved_projects or self.cancelled)
+            if not success:
+                # Not a clean run, so nothing gets deleted, and the journal
+                # stays for next time.
+                stale_files = set()
+                journal = None
+
+            # Everything finished, so now it's safe to clean up; anything
+            # the current manifests use is kept, whichever run found it stale.
+            phase_started = time.time()
+            SetPhase("Cleaning up")
+            if stale_files:
+                stale_files -= ReferencedFiles(destination, Projects + [p for p in projects if p not in Projects])
+            for stale in sorted(stale_files):
+                if debug or verbose:
+                    print("rm %s" % stale, file=sync_log)
+                    if debug:
+                        continue
+                entry = file_index.Lookup(stale) if file_index else None
+                try:
+                    st = os.stat(stale)
+                    os.remove(stale)
+                    CountMetric("FilesDeleted")
+                    # The space only comes back with the last link; that
+                    # may be the blob store's, which then goes too.
+                    freed = st.st_size if st.st_nlink == 1 else 0
+                    if blob_store and entry and entry.get("SHA256"):
+                        freed += blob_store.Release(entry["SHA256"])
+                    CountMetric("BytesDeleted", freed)
+                except:
+                    pass
+                if file_index:
+                    file_index.Forget(stale)
+            if journal:
+                journal.Finish()
+            sync_metrics.RecordPhase("Cleanup", phase_started)
+            if self.gc and success:
+                phase_started = time.time()
+                SetPhase("Collecting garbage")
+                (files, nbytes) = CollectGarbage(destination)
+                print("Garbage collection removed %d files, reclaiming %d bytes" % (files, nbytes), file=sync_log)
+                CountMetric("FilesCollected", files)
+                CountMetric("BytesCollected", nbytes)
+                sync_metrics.RecordPhase("GarbageCollection", phase_started)
+            finished = True
+        finally:
+            # Whatever happened, don't leave threads and connections
+            # behind, or the run looking as if it is still going.
+            if not finished:
+                # Nothing queued is wanted now
+                sync_cancelled.set()
+                pool.Cancel()
+            pool.Close()
+            if file_index:
+                file_index.Close()
+            if not finished and sync_progress:
+                sync_progress.Stop("failed")
+        if file_index:
+            # Only a sync that actually moved some data says anything
+            # useful about throughput.
+            elapsed = time.time() - started
+            if transfer_totals["Bytes"] > 1024 * 1024 and elapsed > 0:
+                stats = LoadSyncStats(destination)
+                stats["Throughput"] = transfer_totals["Bytes"] / elapsed
+                stats["Time"] = int(time.time())
+                SaveSyncStats(destination, stats)
+        if sync_progress:
+            sync_progress.Stop("finished" if success else "cancelled" if self.cancelled else "failed")
+        self.summary = sync_metrics.Summary(pool, success=success)
+        if not debug:
+            sync_metrics.WriteSummary(os.path.join(destination, ".sync-summary"), self.summary)
+        if self.metrics_file:
+            try:
+                sync_metrics.WriteTextfile(self.metrics_file, self.summary)
+            except (IOError, OSError) as e:
+                print("Could not write metrics to %s: %s" % (self.metrics_file, str(e)), file=sync_log)
+        if sync_progress:
+            sync_progress.Notify("finished", self.summary)
+        return success
 
 def main():
     import getopt
-    global debug, verbose
-    global url_list
-    default_urls = ["http://update.freenas.org", "http://update-master.freenas.org"]
 
     def Usage():
-        print("""Usage:\t{0} [-T train] [-P project] [--deep|--no-deep] [-U server_url] destination
+        print("""Usage:\t{0} [-T train] [-P project] [--deep|--no-deep] [-U server_url] [-j jobs] [--mirror-jobs jobs]
+\t\t[--engine threads|events] [--segments count] [--segment-threshold size] [--rate-limit schedule] [--retries count] [--no-dedupe] [--gc] [--keep-releases count]
+\t\t[--fleet-log access_log] [--fleet-versions version,...] [--metrics-file path] [--wait] [--plan] destination
+or\t{0} [-U server_url] --serve [host:]port destination
 or\t{0} [-U server_url] --check-for-update""".format(sys.argv[0]),
               file=sys.stderr)
         sys.exit(1)
 
     try:
-        short_options = "T:P:dv"
+        short_options = "T:P:dvj:"
         long_options = [ "train=",
                          "project=",
                          "debug",
@@ -339,48 +4497,119 @@ or\t{0} [-U server_url] --check-for-update""".format(sys.argv[0]),
                          "url=",
                          "deep",
                          "no-deep",
+                         "jobs=",
+                         "mirror-jobs=",
+                         "engine=",
+                         "plan",
+                         "segments=",
+                         "segment-threshold=",
+                         "rate-limit=",
+                         "retries=",
+                         "no-dedupe",
+                         "gc",
+                         "keep-releases=",
+                         "fleet-log=",
+                         "fleet-versions=",
+                         "serve=",
+                         "metrics-file=",
+                         "wait",
                          ]
         opts, arguments = getopt.getopt(sys.argv[1:], short_options, long_options)
     except getopt.GetoptError as err:
         print(str(err), file=sys.stderr)
         Usage()
 
-    trains = []
-    projects = []
-    deep = False
+    # The Syncer's keyword arguments
+    options = { "urls" : [],
+                "projects" : [],
+                "trains" : [],
+                "fleet_logs" : [],
+                "fleet_versions" : [],
+                }
     do_update = False
+    plan_only = False
+    serve = None
+    wait = False
 
     for o, a in opts:
         if o in ("-T", "--train"):
-            train.append(a)
+            options["trains"].append(a)
         elif o in ("-P", "--project"):
-            projects.append(a)
+            options["projects"].append(a)
         elif o in ("-d", "--debug"):
-            debug = True
+            options["debug"] = True
         elif o in ("-v", "--verbose"):
-            verbose = True
+            options["verbose"] = True
         elif o in ("--check-for-update"):
             do_update = True
         elif o in ("-U", "--url"):
-            url_list.append(a)
+            options["urls"].append(a)
         elif o in ("--deep"):
-            deep = True
+            options["deep"] = True
         elif o in ("--no-deep"):
-            deep = False
+            options["deep"] = False
+        elif o in ("-j", "--jobs"):
+            try:
+                options["jobs"] = int(a)
+            except ValueError:
+                Usage()
+        elif o in ("--mirror-jobs"):
+            try:
+                options["mirror_jobs"] = max(1, int(a))
+            except ValueError:
+                Usage()
+        elif o in ("--engine"):
+            if a not in ("threads", "events"):
+                Usage()
+            options["engine"] = a
+        elif o in ("--plan"):
+            plan_only = True
+        elif o in ("--segments"):
+            try:
+                options["segments"] = int(a)
+            except ValueError:
+                Usage()
+        elif o in ("--segment-threshold"):
+            try:
+                options["segment_threshold"] = ParseSize(a)
+            except ValueError:
+                Usage()
+        elif o in ("--rate-limit"):
+            try:
+                ParseSchedule(a)
+            except ValueError as e:
+                print("Invalid rate limit %s: %s" % (a, str(e)), file=sys.stderr)
+                Usage()
+            options["rate_limit"] = a
+        elif o in ("--no-dedupe"):
+            options["dedupe"] = False
+        elif o in ("--serve"):
+            serve = a
+        elif o in ("--metrics-file"):
+            options["metrics_file"] = a
+        elif o in ("--wait"):
+            wait = True
+        elif o in ("--fleet-log"):
+            options["fleet_logs"].append(a)
+        elif o in ("--fleet-versions"):
+            options["fleet_versions"].extend([v.strip() for v in a.split(",") if v.strip()])
+        elif o in ("--gc"):
+            options["gc"] = True
+        elif o in ("--keep-releases"):
+            try:
+                options["keep_releases"] = int(a)
+            except ValueError:
+                Usage()
+        elif o in ("--retries"):
+            try:
+                options["retries"] = int(a)
+            except ValueError:
+                Usage()
         else:
             Usage()
 
-    if not projects:
-        projects = Projects
-
-    if not trains:
-        trains = None
-
-    if not url_list:
-        url_list = default_urls
-
     if do_update:
-        CheckForUpdate()
+        Syncer(None, **options).CheckForUpdate()
         sys.exit(0)
 
     if len(arguments) == 1:
@@ -388,25 +4617,16 @@ or\t{0} [-U server_url] --check-for-update""".format(sys.argv[0]),
     else:
         Usage()
 
-    for project in projects:
-        existing_files = None
-        if destination:
-            archive = os.path.join(destination, project)
-            existing_files = FindExistingFiles(archive, trains, deep=deep)
+    syncer = Syncer(destination, **options)
+    try:
+        if serve:
+            syncer.Serve(serve)
+        elif plan_only:
+            syncer.Plan()
         else:
-            archive = None
-        GetProject(project, archive, trains, current_files=existing_files, deep=deep)
-        if destination and existing_files:
-            for stale in existing_files.keys():
-                if debug or verbose:
-                    print("rm %s" % stale, file=sys.stderr)
-                    if debug:
-                        continue
-                try:
-                    os.remove(stale)
-                except:
-                    pass
+            return 0 if syncer.Sync(wait=wait) else 1
+    finally:
+        syncer.Close()
 
 if __name__ == "__main__":
-    main()
-    sys.exit(0)
+    sys.exit(main())